@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+from utils import LazyModule
+
+
+markdown2 = LazyModule("markdown2")
+
+LOGGER = logging.getLogger()
+
+
+def block_key(language, codeblock, formatter_opts):
+    sha = hashlib.sha256()
+    sha.update("{}:{}:".format(language, sorted(formatter_opts.items())).encode("utf-8"))
+    sha.update(codeblock.encode("utf-8"))
+    return "{}-{}".format(language, sha.hexdigest())
+
+
+def lexer_language(lexer):
+    return lexer.aliases[0] if len(lexer.aliases) > 0 else lexer.name.lower()
+
+
+#LRU cache of the Pygments output of fenced code blocks, keyed by the language
+#and the hash of the code. With cache_dir the blocks are also kept on disk so
+#the next runs only highlight the blocks that changed
+class HighlightCache(object):
+    def __init__(self, max_entries=4096, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, disk_hits=0, misses=0)
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, "{}.html".format(key))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key]
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                html = f.read()
+            self.put(key, html, disk=False)
+            with self.lock:
+                self.stats["disk_hits"] += 1
+            return html
+
+    def put(self, key, html, disk=True):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if disk and self.cache_dir is not None:
+            filepath = self._disk_path(key)
+            with open(filepath + ".tmp", "w", encoding="utf-8") as f:
+                f.write(html)
+            os.replace(filepath + ".tmp", filepath)
+
+    def highlight(self, render, codeblock, lexer, **formatter_opts):
+        key = block_key(lexer_language(lexer), codeblock, formatter_opts)
+        html = self.get(key)
+        if html is None:
+            with self.lock:
+                self.stats["misses"] += 1
+            html = render(codeblock, lexer, **formatter_opts)
+            self.put(key, html)
+        return html
+
+    def report(self):
+        LOGGER.info("Highlighted code blocks: {hits} from memory, {disk_hits} from disk, "
+            "{misses} highlighted".format(**self.stats))
+
+
+#same as markdown2.markdown, the code blocks highlighted by the
+#fenced-code-blocks extra go through cache
+def markdown(text, extras=None, cache=None):
+    md = markdown2.Markdown(extras=extras)
+    if cache is not None:
+        render = md._color_with_pygments
+        md._color_with_pygments = lambda codeblock, lexer, **formatter_opts:\
+            cache.highlight(render, codeblock, lexer, **formatter_opts)
+    return md.convert(text)
@@ -0,0 +1,120 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+
+
+LOGGER = logging.getLogger()
+
+PROFILES = {
+    "low": dict(height=360, video_bitrate="400k", audio_bitrate="64k"),
+    "medium": dict(height=480, video_bitrate="700k", audio_bitrate="96k"),
+    "high": dict(height=720, video_bitrate="1500k", audio_bitrate="128k"),
+}
+
+
+def file_hash(filepath, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def ffmpeg_command(source, destination, profile):
+    return ["ffmpeg", "-y", "-loglevel", "error", "-i", source,
+        "-vf", "scale=-2:'min({},ih)'".format(profile["height"]),
+        "-c:v", "libx264", "-preset", "medium", "-b:v", profile["video_bitrate"],
+        "-maxrate", profile["video_bitrate"], "-bufsize", "2M",
+        "-c:a", "aac", "-b:a", profile["audio_bitrate"],
+        "-movflags", "+faststart", destination]
+
+
+#records that the original is kept for this source hash and profile
+def write_marker(marker, reason):
+    with open(marker, "w") as f:
+        f.write(reason)
+
+
+#runs in the worker processes, the output is named after the source hash and
+#the profile so a file already encoded with the same profile is not encoded again.
+#When the original is kept (ffmpeg failed or the output wasn't smaller) a
+#.original marker with the same name records it
+def compress_file(source, cache_dir, profile_name):
+    profile = PROFILES[profile_name]
+    destination = os.path.join(cache_dir, "{}_{}.mp4".format(file_hash(source), profile_name))
+    marker = "{}.original".format(os.path.splitext(destination)[0])
+    if os.path.exists(destination):
+        return destination
+    if os.path.exists(marker):
+        return source
+
+    tmp_destination = destination + ".tmp.mp4"
+    try:
+        subprocess.check_call(ffmpeg_command(source, tmp_destination, profile))
+    except (subprocess.CalledProcessError, OSError) as e:
+        LOGGER.info("Error compressing {}: {}".format(source, e))
+        if os.path.exists(tmp_destination):
+            os.remove(tmp_destination)
+        #a missing ffmpeg (OSError) isn't a property of the file
+        if isinstance(e, subprocess.CalledProcessError):
+            write_marker(marker, "ffmpeg failed: {}".format(e))
+        return source
+
+    #the original is kept when the encoded file isn't smaller
+    if os.path.getsize(tmp_destination) >= os.path.getsize(source):
+        os.remove(tmp_destination)
+        write_marker(marker, "encoded file not smaller")
+        return source
+    os.rename(tmp_destination, destination)
+    return destination
+
+
+#Compresses the videos in worker processes while the tree is built, the
+#files are replaced by their results when the tree is complete
+class VideoCompressor(object):
+    def __init__(self, profile_name, cache_dir, workers=None):
+        if profile_name not in PROFILES:
+            raise ValueError("Unknown compression profile {}, use one of {}".format(
+                profile_name, ", ".join(sorted(PROFILES))))
+        self.profile_name = profile_name
+        self.cache_dir = cache_dir
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    #submits the compression of filepath and returns its future, the result is
+    #the compressed file or filepath when the original is kept. A file is
+    #submitted once
+    def compress(self, filepath):
+        if filepath is None or not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+            future = concurrent.futures.Future()
+            future.set_result(filepath)
+            return future
+        with self.lock:
+            if filepath not in self.futures:
+                LOGGER.info("   - Compressing {} ({})".format(filepath, self.profile_name))
+                self.futures[filepath] = self.executor.submit(compress_file, filepath,
+                    self.cache_dir, self.profile_name)
+            return self.futures[filepath]
+
+    #waits for the submitted files, returns the path of every submitted file
+    #to the path of its result
+    def results(self):
+        with self.lock:
+            futures = list(self.futures.items())
+        results = {}
+        for filepath, future in futures:
+            try:
+                results[filepath] = future.result()
+            except Exception as e:
+                LOGGER.info("Error compressing {}: {}".format(filepath, e))
+                results[filepath] = filepath
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,73 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os
+import threading
+import time
+
+
+LOGGER = logging.getLogger()
+
+
+class HookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.trigger.set()
+        self.send_response(202)
+        self.end_headers()
+        self.wfile.write(b"rebuild scheduled\n")
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        LOGGER.info("Hook: " + format % args)
+
+
+def file_mtime(filepath):
+    try:
+        return os.stat(filepath).st_mtime
+    except OSError:
+        return None
+
+
+#Tells the daemon when to look for changes: every `interval` seconds, when
+#touch_file is touched or when http://127.0.0.1:<port>/ is requested
+class RebuildTrigger(object):
+    def __init__(self, interval=60, touch_file=None, port=None):
+        self.interval = interval
+        self.touch_file = touch_file
+        self.touch_mtime = file_mtime(touch_file) if touch_file is not None else None
+        self.port = port
+        self.event = threading.Event()
+        self.server = None
+
+    def start(self):
+        if self.port is not None:
+            self.server = HTTPServer(("127.0.0.1", self.port), HookHandler)
+            self.server.trigger = self.event
+            thread = threading.Thread(target=self.server.serve_forever, name="rebuild-hook")
+            thread.daemon = True
+            thread.start()
+            LOGGER.info("Listening for rebuild hooks on http://127.0.0.1:{}/".format(self.port))
+
+    def touched(self):
+        if self.touch_file is None:
+            return False
+        mtime = file_mtime(self.touch_file)
+        if mtime is not None and mtime != self.touch_mtime:
+            self.touch_mtime = mtime
+            return True
+        return False
+
+    def wait(self):
+        deadline = time.time() + self.interval
+        while time.time() < deadline:
+            if self.event.wait(min(1, max(0, deadline - time.time()))):
+                self.event.clear()
+                return "hook"
+            if self.touched():
+                return "touch"
+        return "poll"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,126 @@
+import concurrent.futures
+import hashlib
+from io import BytesIO
+import logging
+import os
+
+from utils import LazyModule
+
+
+Image = LazyModule("PIL.Image")
+
+LOGGER = logging.getLogger()
+
+JPEG_QUALITY = 75
+WEBP_QUALITY = 75
+WEBP_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def is_webp(data):
+    return data[:4] == b"RIFF" and data[8:12] == b"WEBP"
+
+
+def webp_name(filename):
+    name, ext = os.path.splitext(filename)
+    if ext.lower() in WEBP_EXTENSIONS:
+        return name + ".webp"
+    return filename
+
+
+def encode(img, fmt, webp):
+    out = BytesIO()
+    if webp:
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.save(out, "WEBP", quality=WEBP_QUALITY, method=6)
+    elif fmt == "JPEG":
+        img.convert("RGB").save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == "PNG":
+        img.save(out, "PNG", optimize=True)
+    elif fmt == "GIF":
+        img.save(out, "GIF", optimize=True)
+    else:
+        return None
+    return out.getvalue()
+
+
+#runs in the worker processes, returns the original bytes when the image
+#can't be decoded or encoded or the optimized version isn't smaller
+def optimize_image(data, max_width, webp=False):
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+    except (IOError, OSError, ValueError, Image.DecompressionBombError):
+        return data
+    fmt = img.format
+    if fmt == "GIF" and getattr(img, "is_animated", False):
+        return data
+
+    resized = False
+    try:
+        if max_width and img.width > max_width:
+            height = max(1, int(round(img.height * max_width / float(img.width))))
+            img = img.resize((max_width, height), Image.LANCZOS)
+            resized = True
+        result = encode(img, fmt, webp)
+    except (IOError, OSError, ValueError, Image.DecompressionBombError) as e:
+        LOGGER.warning("Image not optimized: {}".format(e))
+        return data
+
+    if result is None or (not resized and len(result) >= len(data)):
+        return data
+    return result
+
+
+#Optimizes the images of a page in worker processes, the results are kept in
+#cache_dir by the hash of the source bytes and the settings
+class ImageOptimizer(object):
+    def __init__(self, cache_dir, max_width=960, webp=False, workers=None):
+        self.cache_dir = cache_dir
+        self.max_width = max_width
+        self.webp = webp
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.saved_bytes = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def cache_path(self, data, webp):
+        sha = hashlib.sha256(data).hexdigest()
+        return os.path.join(self.cache_dir, "{}_{}{}".format(sha, self.max_width,
+            "_webp" if webp else ""))
+
+    #returns the final (filename, bytes) of every image, an image is renamed
+    #to .webp only when it was encoded as WebP
+    def optimize_many(self, images):
+        results = [None] * len(images)
+        futures = []
+        for i, (filename, data) in enumerate(images):
+            webp = self.webp and webp_name(filename) != filename
+            path = self.cache_path(data, webp)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    results[i] = f.read()
+            else:
+                futures.append((i, path, self.executor.submit(optimize_image, data,
+                    self.max_width, webp)))
+
+        for i, path, future in futures:
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                LOGGER.warning("Image {} not optimized: {}".format(images[i][0], e))
+                results[i] = images[i][1]
+                continue
+            with open(path, "wb") as f:
+                f.write(results[i])
+
+        for (filename, data), result in zip(images, results):
+            self.saved_bytes += len(data) - len(result)
+        return [(webp_name(filename) if is_webp(result) else filename, result)
+            for (filename, _), result in zip(images, results)]
+
+    def report(self):
+        LOGGER.info("Images optimized: {:.1f} MB saved".format(self.saved_bytes / (1024 * 1024.)))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,103 @@
+import hashlib
+import html
+import io
+import logging
+import os
+import zipfile
+
+from manifest import HashingWriter
+from utils import LazyModule
+
+
+pygments = LazyModule("pygments")
+pygments_lexers = LazyModule("pygments.lexers")
+pygments_formatters = LazyModule("pygments.formatters")
+
+LOGGER = logging.getLogger()
+
+CHUNK_SIZE = 64 * 1024
+#bigger files are streamed without highlighting, the lexer needs the whole text
+HIGHLIGHT_MAX_SIZE = 512 * 1024
+CSS_PATH = "css/highlight_default.css"
+PAGE_HEADER = '<html><head><meta charset="utf-8"><title>{title}</title>{css}</head><body>'
+CSS_LINK = '<link rel="stylesheet" href="{}">'
+PAGE_FOOTER = '</body></html>'
+
+
+def file_sha256(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_source(out, filepath, highlight=False):
+    with open(filepath, "r", encoding="utf-8", errors="replace") as f:
+        if highlight and os.path.getsize(filepath) <= HIGHLIGHT_MAX_SIZE:
+            formatter = pygments_formatters.HtmlFormatter(cssclass="codehilite")
+            pygments.highlight(f.read(), pygments_lexers.JavascriptLexer(), formatter, outfile=out)
+        else:
+            out.write('<div class="codehilite"><pre>')
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+                out.write(html.escape(chunk, quote=False))
+            out.write('</pre></div>')
+
+
+def write_page(zf, name, filepath, css, highlight=False):
+    with zf.open(name, "w") as entry:
+        out = io.TextIOWrapper(entry, encoding="utf-8")
+        out.write(PAGE_HEADER.format(title=html.escape(os.path.basename(filepath)),
+            css=CSS_LINK.format(css) if css else ""))
+        write_source(out, filepath, highlight=highlight)
+        out.write(PAGE_FOOTER)
+        out.flush()
+        out.detach()
+
+
+def write_zip(zip_filepath, filepaths, highlight=False, css_filepath=None):
+    with zipfile.ZipFile(zip_filepath, "w", zipfile.ZIP_DEFLATED) as zf:
+        css = None
+        if css_filepath is not None:
+            zf.write(css_filepath, CSS_PATH)
+            css = CSS_PATH
+        if len(filepaths) == 1:
+            write_page(zf, "index.html", filepaths[0], css, highlight=highlight)
+            return
+
+        items = []
+        for filepath in filepaths:
+            name = os.path.basename(filepath)
+            write_page(zf, "files/{}.html".format(name), filepath,
+                "../" + css if css else None, highlight=highlight)
+            items.append('<li><a href="files/{0}.html">{0}</a></li>'.format(html.escape(name)))
+        zf.writestr("index.html", PAGE_HEADER.format(title="",
+            css=CSS_LINK.format(css) if css else "") +\
+            "<ul>{}</ul>".format("".join(items)) + PAGE_FOOTER)
+
+
+#Renders one or several js files into an HTML5 app zip, one page for a single
+#file and an index plus a page per file for a bundle. The zips are kept in
+#cache_dir by the hash of the sources and the options, the copy from the cache
+#is hashed and its digests are returned (None without cache_dir)
+def render_js_zip(filepaths, zip_filepath, highlight=False, css_filepath=None, cache_dir=None):
+    if cache_dir is None:
+        write_zip(zip_filepath, filepaths, highlight=highlight, css_filepath=css_filepath)
+        return
+
+    sha = hashlib.sha256("{}:{}".format(highlight, css_filepath is not None).encode("utf-8"))
+    for filepath in filepaths:
+        sha.update("{}:{}".format(os.path.basename(filepath), file_sha256(filepath)).encode("utf-8"))
+    cached = os.path.join(cache_dir, "{}.zip".format(sha.hexdigest()))
+    if not os.path.exists(cached):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        write_zip(cached + ".tmp", filepaths, highlight=highlight, css_filepath=css_filepath)
+        os.rename(cached + ".tmp", cached)
+    else:
+        LOGGER.info("   - Cached render {}".format(zip_filepath))
+    with open(cached, "rb") as src, open(zip_filepath, "wb") as dst:
+        writer = HashingWriter(dst)
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            writer.write(chunk)
+    return writer.digests()
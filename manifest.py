@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+LOGGER = logging.getLogger()
+
+CHUNK_SIZE = 1024 * 1024
+
+
+#Computes md5, sha256 and size of everything written through it, f can be
+#None to only hash the data
+class HashingWriter(object):
+    def __init__(self, f=None):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if self.f is not None:
+            self.f.write(data)
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def digests(self):
+        return dict(md5=self.md5.hexdigest(), sha256=self.sha256.hexdigest(), size=self.size)
+
+
+def hash_file(filepath):
+    writer = HashingWriter()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            writer.write(chunk)
+    return writer.digests()
+
+
+#Checksums of the files referenced by the channel tree, used by the tree diff
+#and by the --skip-unchanged upload. An entry can be trusted while the size
+#and mtime of its file don't change, so a file isn't hashed twice by the chef
+class Manifest(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stats = dict(streamed=0, hashed=0, trusted=0)
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                self.entries = json.load(f).get("files", {})
+
+    def lookup(self, path):
+        entry = self.entries.get(path)
+        if entry is None or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry
+
+    def record(self, path, digests, stat_name="streamed"):
+        stat = os.stat(path)
+        if stat.st_size != digests["size"]:
+            return
+        with self.lock:
+            self.entries[path] = dict(digests, mtime=stat.st_mtime)
+            self.stats[stat_name] += 1
+        return self.entries[path]
+
+    def record_file(self, path):
+        entry = self.lookup(path)
+        if entry is not None:
+            with self.lock:
+                self.stats["trusted"] += 1
+            return entry
+        return self.record(path, hash_file(path), stat_name="hashed")
+
+    #takes the entries of a manifest written on another host (a shard), an
+    #entry is kept when its file has the same size here, with the local mtime
+    def adopt(self, entries):
+        adopted = 0
+        for path, entry in entries.items():
+            if os.path.exists(path) and os.path.getsize(path) == entry["size"]:
+                with self.lock:
+                    self.entries[path] = dict(entry, mtime=os.stat(path).st_mtime)
+                adopted += 1
+        return adopted
+
+    #makes sure every file of the tree has an entry and drops the others
+    def record_tree(self, channel_tree):
+        paths = set()
+        nodes = [channel_tree]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            nodes.extend(node.get("children", []))
+            for file_ in node.get("files", []):
+                path = file_.get("path")
+                if path is not None and os.path.exists(path):
+                    paths.add(path)
+        for path in sorted(paths):
+            self.record_file(path)
+        self.entries = {path: entry for path, entry in self.entries.items() if path in paths}
+
+    def save(self, filepath=None):
+        with open(filepath or self.filepath, "w") as f:
+            json.dump(dict(files=self.entries), f, indent=2, sort_keys=True)
+
+    def report(self):
+        LOGGER.info("Checksums: {streamed} computed while writing, {hashed} files hashed, "
+            "{trusted} unchanged files trusted".format(**self.stats))
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+LOGGER = logging.getLogger()
+
+FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+#peak resident set size of the process in bytes, ru_maxrss is in KB on linux
+#and in bytes on macOS
+def peak_rss():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def stat_to_dict(stat):
+    frame = stat.traceback[0]
+    return dict(site="{}:{}".format(frame.filename, frame.lineno),
+        size=stat.size, count=stat.count)
+
+
+def diff_to_dict(stat):
+    frame = stat.traceback[0]
+    return dict(site="{}:{}".format(frame.filename, frame.lineno),
+        size=stat.size, size_diff=stat.size_diff, count=stat.count, count_diff=stat.count_diff)
+
+
+#Takes a tracemalloc snapshot at every stage boundary of the build and keeps
+#the top allocation sites, the growth since the previous stage and the traced
+#and resident memory. The resident memory is sampled every `interval` seconds
+#for the peak of each stage. The stages are written as json to filepath after
+#every snapshot, so a run that crashes keeps the stages before the crash
+class MemoryProfiler(object):
+    def __init__(self, filepath, top=15, frames=1, interval=0.1):
+        self.filepath = filepath
+        self.top = top
+        self.frames = frames
+        self.interval = interval
+        self.stages = []
+        self.previous = None
+        self.start_time = None
+        self.stage_rss_peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def sample_rss(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                with self.lock:
+                    self.stage_rss_peak = max(self.stage_rss_peak, rss)
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self.start_time = time.time()
+        self.stage_rss_peak = current_rss() or 0
+        thread = threading.Thread(target=self.sample_rss, name="rss-sampler")
+        thread.daemon = True
+        thread.start()
+        LOGGER.info("Memory profiling enabled, stages are written to {}".format(self.filepath))
+
+    def snapshot(self, stage, **info):
+        snapshot = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.statistics("lineno")
+        rss = current_rss()
+        with self.lock:
+            stage_peak = max(self.stage_rss_peak, rss or 0)
+            self.stage_rss_peak = rss or 0
+        entry = dict(stage=stage, info=info, elapsed=round(time.time() - self.start_time, 3),
+            traced_current=current, traced_peak=peak,
+            rss_current=rss, rss_stage_peak=stage_peak or None, rss_process_peak=peak_rss(),
+            top=[stat_to_dict(stat) for stat in stats[:self.top]])
+        if self.previous is not None:
+            diff = snapshot.compare_to(self.previous, "lineno")
+            entry["growth"] = [diff_to_dict(stat) for stat in diff[:self.top] if stat.size_diff > 0]
+        self.previous = snapshot
+        #so traced_peak is the peak of each stage, python >= 3.9
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self.stages.append(entry)
+        self.save()
+        LOGGER.info("Memory {}: traced {:.1f} MB (peak {:.1f} MB)".format(
+            stage, current / 1024**2, peak / 1024**2))
+        return entry
+
+    def save(self):
+        with open(self.filepath, "w") as f:
+            json.dump(dict(stages=self.stages), f, indent=2)
+
+    def stop(self):
+        self.stopped.set()
+        self.save()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.previous = None
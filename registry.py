@@ -0,0 +1,60 @@
+from collections import defaultdict
+import copy
+import logging
+import os
+
+
+LOGGER = logging.getLogger()
+
+
+#Keeps one node per canonical resource key for the whole run, the first page
+#that links a resource downloads it and the next ones reuse its file and node.
+#A failed download is remembered as None, a resource that wasn't attempted
+#(e.g. a video that can't be downloaded) isn't remembered at all
+class ResourceRegistry(object):
+    def __init__(self):
+        self.nodes = {}
+        self.downloads = defaultdict(int)
+        self.reused = defaultdict(int)
+        self.reused_bytes = 0
+
+    def get_node(self, resource, download, attempt=True):
+        key = resource.key
+        kind = resource.__class__.__name__
+        if key in self.nodes:
+            node = self.nodes[key]
+            self.reused[kind] += 1
+            if node is not None:
+                self.reused_bytes += self.node_size(node)
+                LOGGER.info("   - Reusing {}".format(resource.source_id))
+            return copy.deepcopy(node)
+
+        if not attempt:
+            return None
+        download(resource)
+        node = resource.to_node()
+        self.nodes[key] = node
+        self.downloads[kind] += 1
+        return copy.deepcopy(node)
+
+    #the failed resources are downloaded again the next time they are linked
+    def expire_failures(self):
+        failed = [key for key, node in self.nodes.items() if node is None]
+        for key in failed:
+            del self.nodes[key]
+        return len(failed)
+
+    def node_size(self, node):
+        size = 0
+        for file_ in node.get("files", []):
+            path = file_.get("path")
+            if path is not None and os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+    def report(self):
+        for kind in sorted(set(self.downloads) | set(self.reused)):
+            LOGGER.info("Resources {}: {} fetched, {} duplicates reused".format(
+                kind, self.downloads[kind], self.reused[kind]))
+        LOGGER.info("Duplicate downloads avoided: {} ({:.1f} MB)".format(
+            sum(self.reused.values()), self.reused_bytes / (1024 * 1024.)))
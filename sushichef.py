@@ -1,35 +1,43 @@
 #!/usr/bin/env python
 
-from bs4 import BeautifulSoup
 import codecs
-from collections import defaultdict
+from codecache import HighlightCache, markdown
+from compress import VideoCompressor
+from collections import defaultdict, OrderedDict
 import copy
-from git import Repo
+from daemon import RebuildTrigger
 import glob
 from le_utils.constants import licenses, content_kinds, file_formats
-import hashlib
+from imageopt import ImageOptimizer
 import json
+from jsrender import render_js_zip
 import logging
-import markdown2
-import ntpath
+from manifest import Manifest
+from memprofile import MemoryProfiler
 import os
-import pafy
-from pathlib import Path
 import re
-import requests
-from ricecooker.classes.licenses import get_license
-from ricecooker.chefs import JsonTreeChef
-from ricecooker.utils import downloader, html_writer
-from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter
-from ricecooker.utils.jsontrees import write_tree_to_json_tree, SUBTITLES_FILE
+from registry import ResourceRegistry
+import shutil
+import sys
 import time
-from urllib.error import URLError
+from ricecooker.classes.licenses import get_license
+from treediff import TreeIndex, diff_trees, partial_tree
 from urllib.parse import urljoin
-from utils import if_dir_exists, get_name_from_url, clone_repo, build_path
-from utils import if_file_exists, get_video_resolution_format, remove_links
-from utils import get_name_from_url_no_ext, get_node_from_channel, get_level_map
+from urls import classify_url, resolve_url, get_name_from_url
+from urls import PDF, DRIVE, YOUTUBE, WISTIA
+from utils import if_dir_exists, clone_repo, build_path, repo_head, changed_files
+from utils import if_file_exists, remove_links
+from utils import get_node_from_channel, get_level_map, LazyModule
 from utils import remove_iframes, get_confirm_token, save_response_content
-import youtube_dl   
+from videopool import VideoWorkerPool
+from webclient import AsyncHTTPClient, SQLiteCache, HTTPError, FOREVER, REVALIDATE
+
+bs4 = LazyModule("bs4")
+html_writer = LazyModule("ricecooker.utils.html_writer")
+jsontrees = LazyModule("ricecooker.utils.jsontrees")
+ricecooker_config = LazyModule("ricecooker.config")
+ricecooker_chefs = LazyModule("ricecooker.chefs")
+ricecooker_files = LazyModule("ricecooker.classes.files")
 
 
 BASE_URL = "https://github.com/Laboratoria/"
@@ -49,13 +57,95 @@ LOGGER.addHandler(__logging_handler)
 LOGGER.setLevel(logging.INFO)
 
 DOWNLOAD_VIDEOS = True
+VIDEO_WORKERS = 4
+VIDEO_RATE = 1.
+VIDEO_COMPRESSOR = None
+IMAGE_OPTIMIZER = None
+MANIFEST = None
+PROFILER = None
+CODE_CACHE = HighlightCache()
+JS_HIGHLIGHT = False
+JS_BUNDLE = False
+
+WEBCACHE_PATH = ".webcache.sqlite3"
+WEBCACHE_MAX_SIZE = 1024
+WEBCACHE_POLICIES = {
+    "github.com": FOREVER,
+    "raw.githubusercontent.com": FOREVER,
+    "drive.google.com": REVALIDATE,
+    "docs.google.com": REVALIDATE,
+    "wistia.com": REVALIDATE,
+    "wistia.net": REVALIDATE,
+}
+
+HTTP_CLIENT = None
+
+
+def http_client():
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None:
+        cache = SQLiteCache(WEBCACHE_PATH, max_size=WEBCACHE_MAX_SIZE * 1024 * 1024)
+        HTTP_CLIENT = AsyncHTTPClient(cache=cache, policies=WEBCACHE_POLICIES)
+    return HTTP_CLIENT
+
+
+VIDEO_POOL = None
+
+
+def video_pool():
+    global VIDEO_POOL
+    if VIDEO_POOL is None:
+        VIDEO_POOL = VideoWorkerPool(workers=VIDEO_WORKERS, rate=VIDEO_RATE,
+            metadata_dir=os.path.join(DATA_DIR, "videos_info"), postprocess=finish_video)
+    return VIDEO_POOL
+
+
+#the video nodes keep the downloaded file while it is compressed, see resolve_videos
+def compress_video(filepath):
+    if VIDEO_COMPRESSOR is not None:
+        VIDEO_COMPRESSOR.compress(filepath)
+    return filepath
+
+
+#waits for the compressed videos and puts them in place of the downloaded
+#files in the tree
+def resolve_videos(channel_tree):
+    if VIDEO_COMPRESSOR is None:
+        return
+    compressed = VIDEO_COMPRESSOR.results()
+    for filepath in set(compressed.values()):
+        record_artifact(filepath)
+    nodes = [channel_tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        nodes.extend(node.get("children", []))
+        for file_ in node.get("files", []):
+            if file_.get("path") in compressed:
+                file_["path"] = compressed[file_["path"]]
+
+
+def profile_memory(stage, **info):
+    if PROFILER is not None:
+        PROFILER.snapshot(stage, **info)
+
+
+def record_artifact(filepath, digests=None):
+    if MANIFEST is None or filepath is None or not if_file_exists(filepath):
+        return
+    if digests is None:
+        MANIFEST.record_file(filepath)
+    else:
+        MANIFEST.record(filepath, digests)
+
 
-sess = requests.Session()
-cache = FileCache('.webcache')
-basic_adapter = CacheControlAdapter(cache=cache)
-forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
-sess.mount('http://', basic_adapter)
-sess.mount(BASE_URL, forever_adapter)
+#runs in the video workers, after the download
+def finish_video(filepath):
+    record_artifact(filepath)
+    return compress_video(filepath)
+
+SUBDIR_PATTERN = re.compile(r'\d{1,2}\-')
+SHARD_PATTERN = re.compile(r'^(\d+)/(\d+)$')
+RESOURCES = ResourceRegistry()
 
 
 
@@ -69,11 +159,10 @@ class HTMLApp(object):
 
     def get_subdirs(self):
         dirs = []
-        pattern = re.compile('\d{1,2}\-')
         if self.page.content is None:
             return dirs
         links = self.page.content.find_all(lambda tag: tag.name == "a" and\
-            tag.findParent("h3"), href=pattern)
+            tag.findParent("h3"), href=SUBDIR_PATTERN)
         for a in links:
             dirs.append(a["href"])
         return dirs
@@ -82,8 +171,8 @@ class HTMLApp(object):
         path = [DATA_DIR] + self.page.pwd[2:]
         filename = self.page.filepath.split("/")[-1]
         self.filepath = os.path.join(build_path(path), "{}.zip".format(filename))
+        images = self.fetch_images(self.page.get_images())
         with html_writer.HTMLWriter(self.filepath, "w") as zipper:
-            images = self.page.get_images()
             content = copy.copy(self.page.content)
             remove_links(content)
             remove_iframes(content)
@@ -103,13 +192,33 @@ class HTMLApp(object):
             content = f.read()
             zipper.write_contents("scrips.js", content, directory="js/")
 
-    def write_images(self, images):
+    #the images are fetched and optimized before the index is written, the src
+    #of an image optimized to WebP is changed to its new name
+    def fetch_images(self, images):
+        responses = http_client().get_many(list(images.keys()))
+        contents = []
+        for img_filename, response in zip(images.values(), responses):
+            if isinstance(response, HTTPError) or response.status != 200:
+                LOGGER.info("Error: image {} {}".format(img_filename, response))
+            else:
+                contents.append((img_filename, response.content))
+        if IMAGE_OPTIMIZER is None:
+            return contents
+
+        optimized = IMAGE_OPTIMIZER.optimize_many(contents)
+        renamed = {self.page.extra_files_path + filename: self.page.extra_files_path + new_filename
+            for (filename, _), (new_filename, _) in zip(contents, optimized)
+            if filename != new_filename}
+        for img in self.page.content.findAll("img"):
+            if img.get("src") in renamed:
+                img["src"] = renamed[img["src"]]
+        return optimized
+
+    def write_images(self, contents):
         with html_writer.HTMLWriter(self.filepath, "a") as zipper:
-            for img_src, img_filename in images.items():
-                try:
-                    zipper.write_url(img_src, img_filename, directory=self.page.extra_files_path)
-                except (requests.exceptions.HTTPError, requests.exceptions.SSLError):
-                    pass
+            for img_filename, content in contents:
+                zipper.write_contents(img_filename, content,
+                    directory=self.page.extra_files_path)
 
     def write_pdfs(self):
         path = [DATA_DIR] + self.page.pwd[2:]
@@ -117,8 +226,7 @@ class HTMLApp(object):
         urllist = UrlPDFList("pdf_white_list.json")
         for pdf in self.page.get_pdfs():
             if urllist.valid_url(pdf.source_id):
-                pdf.download(path)
-                yield pdf.to_node()
+                yield RESOURCES.get_node(pdf, lambda pdf: pdf.download(path))
 
     def write_videos(self):
         path = [DATA_DIR] + self.page.pwd[2:]
@@ -126,8 +234,9 @@ class HTMLApp(object):
         urllist = UrlVideoList("youtube_white_list.json")
         for video in self.page.get_videos():
             if urllist.valid_url(video.source_id) or video.is_valid:
-                video.download(download=DOWNLOAD_VIDEOS, base_path=path)
-                yield video.to_node()
+                yield RESOURCES.get_node(video, lambda video: video.download(
+                    download=DOWNLOAD_VIDEOS, base_path=path),
+                    attempt=video.can_download(DOWNLOAD_VIDEOS))
 
     def topic_node(self):
         return dict(
@@ -192,8 +301,7 @@ class MarkdownReader(object):
 
     def level_counter(self, clean_title):
         levels = self.filepath.replace("README.md", "")
-        path_str = "/".join(levels.split("/")[:-1]) + clean_title
-        key = hashlib.sha1(path_str.encode("utf-8")).hexdigest()
+        key = ("/".join(levels.split("/")[:-1]), clean_title)
         COUNTER_TITLE_KEYS[key] += 1
         return COUNTER_TITLE_KEYS[key]
 
@@ -216,7 +324,7 @@ class MarkdownReader(object):
         try:
             with codecs.open(self.filepath, mode="r", encoding="utf-8") as input_file:
                 text = input_file.read()
-                html = markdown2.markdown(text, extras=["tables", "fenced-code-blocks"])
+                html = markdown(text, extras=["tables", "fenced-code-blocks"], cache=CODE_CACHE)
         except FileNotFoundError as e:
             LOGGER.info("Error: {}".format(e))
         else:
@@ -224,56 +332,58 @@ class MarkdownReader(object):
 
     def parser(self, document):
         if document is not None:
-            return BeautifulSoup(document, 'html.parser')
+            return bs4.BeautifulSoup(document, 'html.parser')
 
     def get_images(self):
         images = {}
+        unique_keys = set([])
         for img in self.content.findAll("img"):
             if "src" in img.attrs:
                 if img["src"].startswith("/"):
-                    img_src = urljoin(BASE_URL, img["src"])
-                elif not img["src"].startswith("http"):
-                    img_src = urljoin(BASE_URL, "/".join(self.pwd[2:]), img["src"])
+                    img_src = resolve_url(img["src"], BASE_URL)
                 else:
-                    img_src = img["src"]
-            
-                if img_src not in images and img_src:
+                    img_src = resolve_url(img["src"], self.url)
+
+                key = classify_url(img_src).key
+                if key not in unique_keys and img_src:
                     filename = get_name_from_url(img_src)
                     img["src"] = self.extra_files_path+filename
                     images[img_src] = filename
+                    unique_keys.add(key)
         return images
 
     def get_pdfs(self):
-        unique_urls = set([])
-        files = self.get_data_fn([lambda tag: tag.name == "a" and tag.attrs.get("href", "").endswith(".pdf")], 
-            {}, "href", File, unique_urls)
-        files.extend(self.get_data_fn([lambda tag: tag.name == "iframe" and tag.attrs.get("src", "").endswith(".pdf")], {}, "src", File, unique_urls))
-        pattern = re.compile('drive\.google\.com')
-        files.extend(self.get_data_fn(["a"], {"href": pattern}, "href", FileDrive, unique_urls))
-        return files
+        return self.get_data_fn([
+            ("a", "href", PDF, File, {}),
+            ("iframe", "src", PDF, File, {}),
+            ("a", "href", DRIVE, FileDrive, {})])
 
     def get_videos(self):
-        unique_urls = set([])
-        pattern = re.compile('youtube.com|youtu\.be')
-        videos = self.get_data_fn(["a"], {"href": pattern}, "href", YouTubeResource, 
-            unique_urls)
-        videos.extend(self.get_data_fn(["iframe"], {"src": pattern}, "src", 
-            YouTubeResource, unique_urls, embeded=True))
-        pattern = re.compile('laboratoria.wistia.com')
-        videos.extend(self.get_data_fn(["a"], {"href": pattern}, "href", 
-            WistiaVideoResource, unique_urls))
-        return videos
-
-    def get_data_fn(self, fn_args, fn_kwargs, attr, class_, unique_urls, **extra_params):        
+        return self.get_data_fn([
+            ("a", "href", YOUTUBE, YouTubeResource, {}),
+            ("iframe", "src", YOUTUBE, YouTubeResource, {"embeded": True}),
+            ("a", "href", WISTIA, WistiaVideoResource, {})])
+
+    #every tag is classified once, the resources are built in the order
+    #of the sources list and deduplicated by their canonical url key
+    def get_data_fn(self, sources):
+        buckets = [[] for _ in sources]
+        for tag in self.content.find_all(["a", "iframe"]):
+            for bucket, (name, attr, kind, _, _) in zip(buckets, sources):
+                url = tag.get(attr, None)
+                if tag.name == name and url is not None:
+                    info = classify_url(url)
+                    if info.kind == kind:
+                        bucket.append(info)
+
         data = []
-        for tag in self.content.find_all(*fn_args, **fn_kwargs):
-            url = tag.get(attr, None)
-            LOGGER.info("Tag: {} source url {}".format(tag.name, url))
-            if url is not None:
-                data_obj = class_(url, lang="es", **extra_params)
-                if data_obj.source_id not in unique_urls:
-                    data.append(data_obj)
-                    unique_urls.add(data_obj.source_id)
+        unique_keys = set([])
+        for bucket, (_, _, _, class_, extra_params) in zip(buckets, sources):
+            for info in bucket:
+                if info.key not in unique_keys:
+                    LOGGER.info("Tag: {} source url {}".format(info.kind, info.url))
+                    data.append(class_(info.url, lang="es", **extra_params))
+                    unique_keys.add(info.key)
         return data
 
     def read_dir(self):
@@ -314,6 +424,7 @@ class MarkdownReader(object):
         images = htmlapp.write_index()
         htmlapp.write_images(images)
         htmlapp.write_css_js()
+        record_artifact(htmlapp.filepath)
         htmlapp_node = self._set_node(htmlapp, channel_tree)
         for node in htmlapp.write_pdfs():
             if node is not None:
@@ -353,7 +464,13 @@ class YouTubeResource(object):
         self.filename = None
         self.type_name = type_name
         self.filepath = None
-        if embeded is True:
+        info = classify_url(source_id)
+        self.key = info.key
+        #every variant of a video (youtu.be, embed/, watch?v=) is the same
+        #downloadable resource
+        if info.kind == YOUTUBE:
+            self.source_id = YouTubeResource.watch_url(self.key)
+        elif embeded is True:
             self.source_id = YouTubeResource.transform_embed(source_id)
         else:
             self.source_id = self.clean_url(source_id)
@@ -373,78 +490,41 @@ class YouTubeResource(object):
             youtube = youtube and url.find("user") == -1 and url.find("/c/") == -1
         return youtube
 
+    @classmethod
+    def watch_url(self, key):
+        return "https://www.youtube.com/watch?v={}".format(key.split(":", 1)[1])
+
     @classmethod
     def transform_embed(self, url):
         url = "".join(url.split("?")[:1])
         return url.replace("embed/", "watch?v=").strip()
 
-    def get_video_info(self, download_to=None, subtitles=True):
-        ydl_options = {
-                'writesubtitles': subtitles,
-                'allsubtitles': subtitles,
-                'no_warnings': True,
-                'restrictfilenames':True,
-                'continuedl': True,
-                'quiet': False,
-                'format': "bestvideo[height<={maxheight}][ext=mp4]+bestaudio[ext=m4a]/best[height<={maxheight}][ext=mp4]".format(maxheight='480'),
-                'outtmpl': '{}/%(id)s'.format(download_to),
-                'noplaylist': False
-            }
-
-        with youtube_dl.YoutubeDL(ydl_options) as ydl:
-            try:
-                ydl.add_default_info_extractors()
-                info = ydl.extract_info(self.source_id, download=(download_to is not None))
-                return info
-            except(youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
-                    youtube_dl.utils.ExtractorError) as e:
-                LOGGER.info('An error occured ' + str(e))
-                LOGGER.info(self.source_id)
-            except KeyError as e:
-                LOGGER.info(str(e))
-
     def subtitles_dict(self):
         subs = []
-        video_info = self.get_video_info()
+        video_info = video_pool().info(self.source_id)
         if video_info is not None:
             video_id = video_info["id"]
-            if 'subtitles' in video_info:
-                subtitles_info = video_info["subtitles"]
-                for language in subtitles_info.keys():
-                    subs.append(dict(file_type=SUBTITLES_FILE, youtube_id=video_id, language=language))
+            for language in video_info["subtitles"]:
+                subs.append(dict(file_type=jsontrees.SUBTITLES_FILE, youtube_id=video_id, language=language))
         return subs
 
-    #youtubedl has some troubles downloading videos in youtube,
-    #sometimes raises connection error
-    #for that I choose pafy for downloading
+    def can_download(self, download=True):
+        return "watch?" in self.source_id and not "/user/" in self.source_id and\
+            download is True
+
     def download(self, download=True, base_path=None):
-        if not "watch?" in self.source_id or "/user/" in self.source_id or\
-            download is False:
+        if not self.can_download(download):
             return
 
         download_to = build_path([base_path, 'videos'])
-        for i in range(4):
-            try:
-                info = self.get_video_info(download_to=download_to, subtitles=False)
-                if info is not None:
-                    LOGGER.info("Video resolution: {}x{}".format(info.get("width", ""), info.get("height", "")))
-                    self.filepath = os.path.join(download_to, "{}.mp4".format(info["id"]))
-                    self.filename = info["title"]
-                    if self.filepath is not None and os.stat(self.filepath).st_size == 0:
-                        LOGGER.info("Empty file")
-                        self.filepath = None
-            except (ValueError, IOError, OSError, URLError, ConnectionResetError) as e:
-                LOGGER.info(e)
-                LOGGER.info("Download retry")
-                time.sleep(.8)
-            except (youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
-                    youtube_dl.utils.ExtractorError, OSError) as e:
-                LOGGER.info("An error ocurred, may be the video is not available.")
-                return
-            except OSError:
-                return
-            else:
-                return
+        info = video_pool().submit(self.key, self.source_id, download_to).result()
+        if info is not None:
+            LOGGER.info("Video resolution: {}x{}".format(info.get("width", ""), info.get("height", "")))
+            self.filepath = info["filepath"]
+            self.filename = info["title"]
+            if not if_file_exists(self.filepath) or os.stat(self.filepath).st_size == 0:
+                LOGGER.info("Empty file")
+                self.filepath = None
 
     def to_node(self):
         if self.filepath is not None:
@@ -465,31 +545,42 @@ class LocalVideoResource(object):
     def __init__(self, source_id, type_name="Local Video", lang="es"):
         LOGGER.info("Resource Type: "+type_name)
         self.source_id = source_id
+        self.key = classify_url(source_id).key
         self.file_format = file_formats.MP4
-        self.lang = lang        
+        self.lang = lang
         self.filename = None
         self.type_name = type_name
         self.filepath = None
         self.is_valid = True
 
+    def can_download(self, download=True):
+        return download is True
+
     def download(self, download=True, base_path=None):
-        if download is False:
+        if not self.can_download(download):
             return
         download_to = build_path([base_path, 'videos'])
-        response = requests.get(self.source_id, stream=True)
-        if response.headers.get("content-type") != 'video/mp4':
-            return
         self.filename = get_name_from_url(self.source_id)
         self.filepath = os.path.join(download_to, "{}.mp4".format(self.filename))
         if if_file_exists(self.filepath):
             LOGGER.info("Video already downloaded {}".format(self.filepath))
         else:
-            with open(self.filepath, 'wb') as f:
-                LOGGER.info("   - Downloading {}".format(self.source_id))
-                save_response_content(response, self.filepath)
+            LOGGER.info("   - Downloading {}".format(self.source_id))
+            try:
+                response = http_client().download(self.source_id, self.filepath,
+                    content_type='video/mp4')
+            except HTTPError as e:
+                LOGGER.info("Error: {}".format(e))
+                response = None
+            if response is None or response.path is None:
+                self.filepath = None
+                return
+            record_artifact(self.filepath, response.digests)
         if self.filepath is not None and os.stat(self.filepath).st_size == 0:
             LOGGER.info("Empty file")
             self.filepath = None
+        record_artifact(self.filepath)
+        self.filepath = compress_video(self.filepath)
 
     def to_node(self):
         if self.filepath is not None:
@@ -510,8 +601,8 @@ class WistiaVideoResource(LocalVideoResource):
         self.get_url_from_embeded()
         
     def get_url_from_embeded(self):
-        r = requests.get(self.source_id)
-        parser = BeautifulSoup(r.content, 'html.parser')
+        r = http_client().get(self.source_id)
+        parser = bs4.BeautifulSoup(r.content, 'html.parser')
         pattern = re.compile("videoUrl=")
         meta = parser.find("meta", content=pattern)
         if meta is not None:
@@ -525,12 +616,13 @@ class File(object):
     def __init__(self, source_id, lang="en", lincese="", drive=True):
         self.filename = get_name_from_url(source_id)
         self.source_id = urljoin(BASE_URL, source_id) if source_id.startswith("/") else source_id
+        self.key = classify_url(self.source_id).key
         self.filepath = None
         self.lang = lang
         self.license = get_license(licenses.CC_BY_SA, copyright_holder=COPYRIGHT_HOLDER).as_dict()
 
     def is_pdf(self):
-        response = sess.get(self.source_id)
+        response = http_client().get(self.source_id)
         content_type = response.headers.get('content-type')
         if content_type is not None and 'application/pdf' in content_type:
             return response
@@ -541,17 +633,9 @@ class File(object):
             response = self.is_pdf()
             if response is not None:
                 self.filepath = os.path.join(PDFS_DATA_DIR, self.filename)
-                save_response_content(response, self.filepath)
+                record_artifact(self.filepath, save_response_content(response, self.filepath))
                 LOGGER.info("   - Get file: {}".format(self.filename))
-        except requests.exceptions.HTTPError as e:
-            LOGGER.info("Error: {}".format(e))
-        except requests.exceptions.ConnectionError:
-            ### this is a weird error, may be it's raised when the webpage
-            ### is slow to respond requested resources
-            LOGGER.info("Connection error, the resource will be scraped in 5s...")
-        except requests.exceptions.ReadTimeout as e:
-            LOGGER.info("Error: {}".format(e))
-        except requests.exceptions.TooManyRedirects as e:
+        except HTTPError as e:
             LOGGER.info("Error: {}".format(e))
 
     def to_node(self):
@@ -573,6 +657,7 @@ class File(object):
 class FileDrive(File):
     def __init__(self, source_id, lang="en", lincese="", drive=True):
         self.source_id = source_id.strip()
+        self.key = classify_url(self.source_id).key
         self.id = self.get_id_from_url()
         self.filename = "googledrive_{}.pdf".format(self.id)
         self.filepath = None
@@ -580,22 +665,17 @@ class FileDrive(File):
         self.license = get_license(licenses.CC_BY_SA, copyright_holder=COPYRIGHT_HOLDER).as_dict()
 
     def get_id_from_url(self):
-        url = self.source_id
-        if url.find("file/d/") != -1:
-            index = url.find("file/d/")
-            end_index = index + len("file/d/") + url[index+len("file/d/"):].find("/")
-            return url[index+len("file/d/"):end_index].strip()
-        elif url.find("?id=") != -1:
-            index = url.find("?id=")
-            return url[index+len("?id="):].strip()
+        info = classify_url(self.source_id)
+        if info.kind == DRIVE:
+            return info.key[len(DRIVE)+1:]
 
     def is_pdf(self):
         URL = "https://docs.google.com/uc?export=download"
-        response = sess.get(URL, params={'id': self.id}, stream=True)
+        response = http_client().get(URL, params={'id': self.id})
         token = get_confirm_token(response)
         if token:
-            params = {'id':id, 'confirm':token}
-            response = sess.get(URL, params=params, stream=True)
+            params = {'id': self.id, 'confirm': token}
+            response = http_client().get(URL, params=params)
         content_type = response.headers.get('content-type')
         if content_type is not None and 'application/pdf' in content_type:
             return response
@@ -606,17 +686,9 @@ class FileDrive(File):
             response = self.is_pdf()
             if response is not None:
                 self.filepath = os.path.join(PDFS_DATA_DIR, self.filename)
-                save_response_content(response, self.filepath)
+                record_artifact(self.filepath, save_response_content(response, self.filepath))
                 LOGGER.info("   - Get file: {}".format(self.filename))
-        except requests.exceptions.HTTPError as e:
-            LOGGER.info("Error: {}".format(e))
-        except requests.exceptions.ConnectionError:
-            ### this is a weird error, may be it's raised when the webpage
-            ### is slow to respond requested resources
-            LOGGER.info("Connection error, the resource will be scraped in 5s...")
-        except requests.exceptions.ReadTimeout as e:
-            LOGGER.info("Error: {}".format(e))
-        except requests.exceptions.TooManyRedirects as e:
+        except HTTPError as e:
             LOGGER.info("Error: {}".format(e))
 
 
@@ -626,6 +698,7 @@ class LocalJSFile(object):
         self.pwd = source_id.split("/")[:-1]
         self.source_id = self.pwd2url()
         self.filepath = os.path.join(*self.pwd, self.filename)
+        self.title = self.filename
         self.lang = lang
         self.license = get_license(licenses.CC_BY_SA, copyright_holder=COPYRIGHT_HOLDER).as_dict()
         self.zip_filepath = None
@@ -633,18 +706,23 @@ class LocalJSFile(object):
     def pwd2url(self):
         return urljoin(BASE_URL, "/".join(self.pwd[2:]+[self.filename]))
 
+    def sources(self):
+        return [self.filepath]
+
     def write_index(self):
         path = [DATA_DIR] + self.pwd[2:]
         self.zip_filepath = os.path.join(build_path(path), "{}.zip".format(self.filename))
-        with html_writer.HTMLWriter(self.zip_filepath, "w") as zipper, open(self.filepath, 'r') as f:
-            zipper.write_index_contents('<html><head><meta charset="utf-8"></head><body>'+f.read().replace("\n", "<br>")+"</body></html>")
+        css = os.path.join(DATA_DIR, "highlight_default.css") if JS_HIGHLIGHT else None
+        digests = render_js_zip(self.sources(), self.zip_filepath, highlight=JS_HIGHLIGHT,
+            css_filepath=css, cache_dir=os.path.join(DATA_DIR, "js_cache"))
+        record_artifact(self.zip_filepath, digests)
 
     def to_node(self):
         if self.zip_filepath is not None:
             return dict(
                 kind=content_kinds.HTML5,
                 source_id=self.source_id,
-                title=self.filename,
+                title=self.title,
                 description="",
                 thumbnail=None,
                 author="",
@@ -656,6 +734,23 @@ class LocalJSFile(object):
                 license=get_license(licenses.CC_BY, copyright_holder=COPYRIGHT_HOLDER).as_dict())
 
 
+#All the js files of a directory in one HTML5 app
+class LocalJSBundle(LocalJSFile):
+    def __init__(self, js_files, lang="en", lincese=""):
+        self.js_files = js_files
+        self.filename = "js"
+        self.pwd = js_files[0].pwd
+        self.source_id = self.pwd2url()
+        self.filepath = None
+        self.title = "JavaScript"
+        self.lang = lang
+        self.license = get_license(licenses.CC_BY_SA, copyright_holder=COPYRIGHT_HOLDER).as_dict()
+        self.zip_filepath = None
+
+    def sources(self):
+        return [js_file.filepath for js_file in self.js_files]
+
+
 def folder_walker(repo_dir, dirs, channel_tree):
     for directory in dirs:
         LOGGER.info("--- {} {}".format(repo_dir, directory))
@@ -671,6 +766,8 @@ def folder_walker(repo_dir, dirs, channel_tree):
             htmlapp_node = md.add_empty_node(channel_tree)
 
         js_files = get_js_files(os.path.join(repo_dir, directory))
+        if JS_BUNDLE and len(js_files) > 1:
+            js_files = [LocalJSBundle(js_files)]
         for js_fileobj in js_files:
             js_fileobj.write_index()
             htmlapp_node["children"].append(js_fileobj.to_node())
@@ -678,7 +775,7 @@ def folder_walker(repo_dir, dirs, channel_tree):
         folder_walker(os.path.join(repo_dir, directory), subdirs, channel_tree)
 
 
-def folder_walker_items(repo_dir, dirs, urllist, attr='get_pdfs'):
+def folder_walker_items(repo_dir, dirs, urllist, attr='get_pdfs', prefetch=None):
     for directory in dirs:
         LOGGER.info("--- {} {}".format(repo_dir, directory))
         files = get_md_files(os.path.join(repo_dir, directory))
@@ -686,12 +783,25 @@ def folder_walker_items(repo_dir, dirs, urllist, attr='get_pdfs'):
             for filepath in files:
                 md = MarkdownReader(filepath, extra_files_path="files/")
                 md.load_content()
-                urllist.add_batch(getattr(md, attr)())#md.get_pdfs())
+                items = getattr(md, attr)()
+                urllist.add_batch(items)
+                if prefetch is not None:
+                    prefetch(md, items, urllist)
         else:
             md = MarkdownReader(os.path.join(repo_dir, directory, "README.md"), 
                 extra_files_path="files/", title=directory)
         subdirs = md.read_dir()
-        folder_walker_items(os.path.join(repo_dir, directory), subdirs, urllist, attr=attr)
+        folder_walker_items(os.path.join(repo_dir, directory), subdirs, urllist, attr=attr,
+            prefetch=prefetch)
+
+
+#the youtube videos start downloading in the pool while the pages are written
+def prefetch_videos(md, videos, urllist):
+    for video in videos:
+        if isinstance(video, YouTubeResource) and video.can_download(DOWNLOAD_VIDEOS) and\
+                urllist.valid_url(video.source_id):
+            download_to = build_path([DATA_DIR] + md.pwd[2:] + ['videos'])
+            video_pool().submit(video.key, video.source_id, download_to)
 
 
 
@@ -710,6 +820,12 @@ class UrlList(object):
             #    self.urls = {}
         else:
             self.urls = {}
+        #any variant of an url (youtu.be/X, watch?v=X, embed/X) is checked
+        #against the same canonical key
+        self.keys = {}
+        for url, value in self.urls.items():
+            key = classify_url(url).key
+            self.keys[key] = max(value, self.keys.get(key, 0))
 
     def save(self):
         if self.new_elem == True:
@@ -720,23 +836,27 @@ class UrlList(object):
         try:
             return self.urls[url] == 1
         except KeyError:
-            return False
+            return self.keys.get(classify_url(url).key) == 1
+
+    def add(self, url):
+        key = classify_url(url).key
+        if not url in self.urls and not key in self.keys:
+            self.urls[url] = 0
+            self.keys[key] = 0
+            self.new_elem = True
 
 
 class UrlPDFList(UrlList):
     def add_batch(self, file_objs):
         for file_obj in file_objs:
-            if not file_obj.source_id in self.urls and file_obj.is_pdf() is not None:
-                self.urls[file_obj.source_id] = 0
-                self.new_elem = True
+            if not file_obj.key in self.keys and file_obj.is_pdf() is not None:
+                self.add(file_obj.source_id)
 
 
 class UrlVideoList(UrlList):
     def add_batch(self, video_objs):
         for video_obj in video_objs:
-            if not video_obj.source_id in self.urls:
-                self.urls[video_obj.source_id] = 0
-                self.new_elem = True
+            self.add(video_obj.source_id)
 
 
 def get_md_files(path):
@@ -763,46 +883,146 @@ def get_md_files(path):
 
 def get_js_files(path):
     js_files = []
-    for js_file in glob.glob(os.path.join(path, "*.js")):
+    for js_file in sorted(glob.glob(os.path.join(path, "*.js"))):
         js_files.append(LocalJSFile(js_file))
     return js_files
 
 
-#When a node has only one child and this child it's a object (file, video, etc),
-#this is moved to an upper level
-def clean_leafs_nodes_plus(channel_tree):
-    children = channel_tree.get("children", None)
-    if children is None:
-        return
-    elif len(children) == 1 and not "children" in children[0]:
-        return channel_tree["children"][0]
-    elif len(children) == 0:
-        return -1
-    else:
-        del_nodes = []
-        for i, node in enumerate(children):
-            leaf_node = clean_leafs_nodes_plus(node)
-            if leaf_node is not None and leaf_node != -1:
-                if leaf_node["source_id"].endswith(".js"):
-                    levels = leaf_node["source_id"].split("/")
-                    parent_dir = levels[-2] #dirname
-                    leaf_node["title"] = "{}_{}".format(parent_dir, leaf_node["title"])
-                children[i] = leaf_node
-            elif leaf_node == -1:
-                del children[i]
-            elif leaf_node is None:
-                try:
-                    if len(node["children"]) == 0:
-                        del children[i]
-                    elif len(node["children"]) == 1:
-                        children[i] = node["children"][0]
-                except KeyError:
-                    pass
-
-
-class LaboratoriaChef(JsonTreeChef):
+#A unit is a top level directory of a repository, (repo, None) stands for a
+#repository without directories. The order is used to merge the shards back
+#in the same order a single process run builds the tree
+def repository_units(repos, path):
+    units = []
+    for repo in repos:
+        repo_index = list(REPOSITORY_URL.keys()).index(repo)
+        readme = MarkdownReader(os.path.join(path, repo, "README.md"), extra_files_path="files/")
+        dirs = readme.read_dir()
+        if "00-template" in dirs:
+            dirs = dirs[1:] #skiped 00-template dir
+        if len(dirs) == 0:
+            units.append((repo, None, (repo_index, 0)))
+        for i, directory in enumerate(dirs):
+            units.append((repo, directory, (repo_index, i)))
+    return units
+
+
+#--shard=<repo> selects the units of a repository, --shard=i/N the i-th
+#(starting at 1) of N contiguous blocks of units
+def select_shard(units, shard):
+    match = SHARD_PATTERN.match(shard)
+    if match is None:
+        return [unit for unit in units if unit[0] == shard]
+    index, total = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= total:
+        raise ValueError("Invalid shard {}".format(shard))
+    return units[(index - 1) * len(units) // total:index * len(units) // total]
+
+
+def group_units(units):
+    repo_dirs = OrderedDict()
+    for repo, directory, _ in units:
+        repo_dirs.setdefault(repo, [])
+        if directory is not None:
+            repo_dirs[repo].append(directory)
+    return repo_dirs
+
+
+def remove_child(node, source_id):
+    node["children"] = [child for child in node["children"] if child["source_id"] != source_id]
+
+
+#drops the title counters of the pages under directory, before building it again
+def reset_counters(directory):
+    for key in list(COUNTER_TITLE_KEYS.keys()):
+        if key[0] == directory or key[0].startswith(directory + "/"):
+            del COUNTER_TITLE_KEYS[key]
+
+
+def shard_filename(shard):
+    return "{}.json".format(shard.replace("/", "-of-"))
+
+
+def shard_manifest_filename(filepath):
+    return "{}.manifest.json".format(os.path.splitext(filepath)[0])
+
+
+def missing_files(channel_tree):
+    missing = []
+    nodes = [channel_tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        nodes.extend(node.get("children", []))
+        for file_ in node.get("files", []):
+            path = file_.get("path")
+            if path is not None and not if_file_exists(path):
+                missing.append(path)
+    return sorted(set(missing))
+
+
+#Topics with the same source_id are merged, the content nodes shared by the
+#shards (the README page of a repository) are added once
+def merge_tree(tree, other):
+    index = {node["source_id"]: node for node in tree["children"]}
+    for node in other.get("children", []):
+        current = index.get(node["source_id"])
+        if current is None:
+            tree["children"].append(node)
+        elif "children" in current and "children" in node:
+            merge_tree(current, node)
+
+
+def merge_shards(filepaths):
+    shards = []
+    for filepath in filepaths:
+        with open(filepath, "r") as f:
+            shards.append(json.load(f))
+    if len(shards) == 0:
+        raise ValueError("No shard files to merge")
+    shards.sort(key=lambda shard: shard["order"])
+    channel_tree = shards[0]["tree"]
+    for shard in shards[1:]:
+        merge_tree(channel_tree, shard["tree"])
+    LOGGER.info("Tree normalized: {} nodes changed".format(normalize_tree(channel_tree)))
+    return channel_tree
+
+
+def hoist_node(node):
+    if not "children" in node and node["source_id"].endswith(".js"):
+        levels = node["source_id"].split("/")
+        prefix = "{}_".format(levels[-2]) #dirname
+        if not node["title"].startswith(prefix):
+            node["title"] = prefix + node["title"]
+    return node
+
+
+#Post-order pass over the tree: topics without children are removed and a
+#topic with only one child is replaced by it, .js files moved up this way get
+#the directory name as title prefix. Every node is visited once and the result
+#has no topics with less than two children, so a second call changes nothing.
+#Returns the number of removed or replaced nodes
+def normalize_tree(node):
+    changed = 0
+    children = []
+    for child in node["children"]:
+        if "children" in child:
+            changed += normalize_tree(child)
+            if len(child["children"]) == 0:
+                changed += 1
+                continue
+            elif len(child["children"]) == 1:
+                changed += 1
+                child = hoist_node(child["children"][0])
+        children.append(child)
+    node["children"] = children
+    return changed
+
+
+#The chef methods, ricecooker's JsonTreeChef is added as base class by
+#make_chef because ricecooker.chefs imports youtube_dl and pressurecooker
+class LaboratoriaChef(object):
     HOSTNAME = BASE_URL
     TREES_DATA_DIR = os.path.join(DATA_DIR, 'trees')
+    SHARDS_DATA_DIR = os.path.join(TREES_DATA_DIR, 'shards')
     SCRAPING_STAGE_OUTPUT_TPL = 'ricecooker_json_tree.json'
     LICENSE = get_license(licenses.CC_BY_SA, copyright_holder=COPYRIGHT_HOLDER).as_dict()
     THUMBNAIL = ""
@@ -811,9 +1031,78 @@ class LaboratoriaChef(JsonTreeChef):
         build_path([LaboratoriaChef.TREES_DATA_DIR])
         self.scrape_stage = os.path.join(LaboratoriaChef.TREES_DATA_DIR, 
                                 LaboratoriaChef.SCRAPING_STAGE_OUTPUT_TPL)
+        self.manifest_path = self.stage_path("manifest.json")
+        self.memory_profile_path = self.stage_path("memory.json")
+        self.skip_unchanged = False
         super(LaboratoriaChef, self).__init__()
 
+    def stage_path(self, suffix):
+        return "{}.{}".format(os.path.splitext(self.scrape_stage)[0], suffix)
+
+    #the whole tree is always uploaded, with --skip-unchanged=1 the files of
+    #the nodes that didn't change since the previous run aren't processed again
+    def construct_channel(self, **kwargs):
+        channel = super(LaboratoriaChef, self).construct_channel(**kwargs)
+        if self.skip_unchanged:
+            self.reuse_unchanged_files(channel)
+        return channel
+
+    #ricecooker caches the processed file of a path without looking at its
+    #content. The entries of the unchanged files point to their stored copy
+    #(from the manifest md5) and the entries of the changed files are dropped,
+    #so only those are hashed and copied again
+    def reuse_unchanged_files(self, channel):
+        diff_path = self.stage_path("diff.json")
+        if not if_file_exists(diff_path):
+            LOGGER.info("No tree diff, all the files are processed")
+            return
+        with open(diff_path, "r") as f:
+            changed = set(change["path"] for change in json.load(f)["files"])
+        manifest = MANIFEST if MANIFEST is not None else Manifest(self.manifest_path)
+        formats = set(key for key, _ in file_formats.choices)
+        reused, dropped = 0, 0
+        nodes = [channel]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            nodes.extend(node.children)
+            for file_ in node.files:
+                path = getattr(file_, "path", None)
+                if path is None or not if_file_exists(path):
+                    continue
+                key = "DOWNLOAD:{}".format(path)
+                entry = manifest.lookup(path) if path not in changed else None
+                if entry is not None:
+                    ext = os.path.splitext(path)[1][1:].lower()
+                    filename = "{}.{}".format(entry["md5"],
+                        ext if ext in formats else file_.default_ext)
+                    if if_file_exists(ricecooker_config.get_storage_path(filename)):
+                        ricecooker_files.FILECACHE.set(key, bytes(filename, "utf-8"))
+                        reused += 1
+                        continue
+                ricecooker_files.FILECACHE.delete(key)
+                dropped += 1
+        LOGGER.info("Upload: {} unchanged files reused, {} files to process".format(
+            reused, dropped))
+
+    #a shard only writes its partial tree, the upload is done after the merge,
+    #the watch mode only keeps the tree json up to date
+    def run(self, args, options):
+        self.skip_unchanged = int(options.get('--skip-unchanged', "0")) == 1
+        if options.get('--shard') is not None or int(options.get('--watch', "0")) == 1:
+            self.pre_run(args, options)
+        else:
+            super(LaboratoriaChef, self).run(args, options)
+
     def pre_run(self, args, options):
+        #--merged=1 uploads the tree written by merge without scraping again
+        if int(options.get('--merged', "0")) == 1:
+            if not if_file_exists(self.scrape_stage):
+                raise ValueError("No merged tree in {}, run the merge command first".format(
+                    self.scrape_stage))
+            LOGGER.info("Uploading the merged tree {}".format(self.scrape_stage))
+            return
+        global WEBCACHE_MAX_SIZE
+        WEBCACHE_MAX_SIZE = int(options.get('--cache-size', WEBCACHE_MAX_SIZE))
         css = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chefdata/styles.css")
         js = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chefdata/scripts.js")
         if not if_file_exists(css) or not if_file_exists(js):
@@ -822,9 +1111,97 @@ class LaboratoriaChef(JsonTreeChef):
         self.scrape(args, options)
 
     def scrape(self, args, options):
+        path = build_path([DATA_DIR, "git"])
+        repos = options.get('--repo', None)
+        shard = options.get('--shard', None)
+        if shard is not None and SHARD_PATTERN.match(shard) is None:
+            repos = [shard]
+        elif repos is None or shard is not None:
+            repos = list(REPOSITORY_URL.keys())
+        else:
+            repos = [repos]
+        self.setup(options)
+
+        #the memory profile is saved even when the build fails
+        try:
+            for repo in repos:
+                clone_repo(REPOSITORY_URL[repo], os.path.join(path, repo))
+            units = repository_units(repos, path)
+            if shard is not None:
+                units = select_shard(units, shard)
+            self.check_urls(units)
+
+            #the counter is reset from previous ingest, its keys depend on the
+            #directory of the page so each shard counts the same as a full run
+            global COUNTER_TITLE_KEYS
+            COUNTER_TITLE_KEYS = defaultdict(int)
+            channel_tree = self.new_channel_tree()
+            for repo, dirs in group_units(units).items():
+                self._build_scraping_json_tree(channel_tree, os.path.join(path, repo), dirs)
+                profile_memory("repo", repo=repo)
+            resolve_videos(channel_tree)
+
+            if shard is None and int(options.get('--watch', "0")) == 1:
+                try:
+                    self.serve(channel_tree, repos, units, options)
+                except KeyboardInterrupt:
+                    LOGGER.info("Daemon stopped")
+            self.finish()
+            if shard is not None:
+                self.write_shard(channel_tree, shard, units)
+            else:
+                self.publish(channel_tree)
+            http_client().close()
+        finally:
+            if PROFILER is not None:
+                PROFILER.stop()
+
+    def setup(self, options):
+        download_video = options.get('--download-video', "1")
+        if int(download_video) == 0:
+            global DOWNLOAD_VIDEOS
+            DOWNLOAD_VIDEOS = False
+
+        global VIDEO_WORKERS, VIDEO_RATE
+        VIDEO_WORKERS = int(options.get('--video-workers', VIDEO_WORKERS))
+        VIDEO_RATE = float(options.get('--video-rate', VIDEO_RATE))
+
+        global VIDEO_COMPRESSOR
+        if options.get('--compress-video') is not None:
+            workers = options.get('--compress-workers')
+            VIDEO_COMPRESSOR = VideoCompressor(options['--compress-video'],
+                os.path.join(DATA_DIR, "compressed"),
+                workers=int(workers) if workers is not None else None)
+
+        global JS_HIGHLIGHT, JS_BUNDLE
+        JS_HIGHLIGHT = int(options.get('--highlight-js', "0")) == 1
+        JS_BUNDLE = int(options.get('--bundle-js', "0")) == 1
+
+        global IMAGE_OPTIMIZER
+        if options.get('--optimize-images') is not None:
+            IMAGE_OPTIMIZER = ImageOptimizer(os.path.join(DATA_DIR, "images_cache"),
+                max_width=int(options['--optimize-images']),
+                webp=int(options.get('--webp', "0")) == 1)
+
+        global MANIFEST
+        MANIFEST = Manifest(self.manifest_path)
+
+        global CODE_CACHE
+        CODE_CACHE = HighlightCache(max_entries=int(options.get('--code-cache', 4096)),
+            cache_dir=os.path.join(DATA_DIR, "code_cache")\
+                if int(options.get('--code-cache-disk', "0")) == 1 else None)
+
+        global PROFILER
+        if int(options.get('--profile-memory', "0")) == 1:
+            PROFILER = MemoryProfiler(self.memory_profile_path)
+            PROFILER.start()
+
+        self.url_pdf_list = UrlPDFList("pdf_white_list.json")
+        self.url_v_list = UrlVideoList("youtube_white_list.json")
+
+    def new_channel_tree(self):
         LANG = 'es'
-        global channel_tree
-        channel_tree = dict(
+        return dict(
                 source_domain=LaboratoriaChef.HOSTNAME,
                 source_id=BASE_URL,
                 title='Laboratoria',
@@ -835,64 +1212,225 @@ class LaboratoriaChef(JsonTreeChef):
                 license=LaboratoriaChef.LICENSE,
             )
 
-        path = build_path([DATA_DIR, "git"])
-        repos = options.get('--repo', None)
-        download_video = options.get('--download-video', "1")
-        if repos is None:
-            repos = REPOSITORY_URL.keys()
-        else:
-            repos = [repos]
-
-        if int(download_video) == 0:
-            global DOWNLOAD_VIDEOS
-            DOWNLOAD_VIDEOS = False
-
-        url_pdf_list = UrlPDFList("pdf_white_list.json")
-        url_v_list = UrlVideoList("youtube_white_list.json")
-        for repo in repos:
-            repo_dir = os.path.join(path, repo)
-            clone_repo(REPOSITORY_URL[repo], repo_dir)
-            readme = MarkdownReader(os.path.join(repo_dir, "README.md"), extra_files_path="files/")
-            folder_walker_items(repo_dir, readme.read_dir(), url_pdf_list, attr='get_pdfs')
-            folder_walker_items(repo_dir, readme.read_dir(), url_v_list, attr='get_videos')
-            url_pdf_list.save()
-            url_v_list.save()
-
-        #the counter is reset from previous ingest
-        global COUNTER_TITLE_KEYS
-        COUNTER_TITLE_KEYS = defaultdict(int)
-        for repo in repos:
+    #adds the new pdf and video links of the units to the white lists
+    def check_urls(self, units):
+        path = os.path.join(DATA_DIR, "git")
+        for repo, dirs in group_units(units).items():
             repo_dir = os.path.join(path, repo)
-            self._build_scraping_json_tree(channel_tree, repo_dir)
+            folder_walker_items(repo_dir, dirs, self.url_pdf_list, attr='get_pdfs')
+            folder_walker_items(repo_dir, dirs, self.url_v_list, attr='get_videos',
+                prefetch=prefetch_videos)
+            self.url_pdf_list.save()
+            self.url_v_list.save()
+
+    def finish(self):
+        video_pool().shutdown()
+        if VIDEO_COMPRESSOR is not None:
+            VIDEO_COMPRESSOR.shutdown()
+        if IMAGE_OPTIMIZER is not None:
+            IMAGE_OPTIMIZER.report()
+            IMAGE_OPTIMIZER.shutdown()
+        RESOURCES.report()
+        CODE_CACHE.report()
+        http_client().report()
+
+    def publish(self, channel_tree):
+        LOGGER.info("Tree normalized: {} nodes changed".format(normalize_tree(channel_tree)))
         self.write_tree_to_json(channel_tree, "en")
 
+    #Keeps the parsed tree, the resource registry, the caches and the pools of
+    #the first build in memory. Every time the trigger fires the repositories
+    #are pulled and only the top level directories with changed files are built
+    #again, a change in the README.md or in the directory list of a repository
+    #builds that whole repository
+    def serve(self, channel_tree, repos, units, options):
+        path = os.path.join(DATA_DIR, "git")
+        port = options.get('--watch-port')
+        trigger = RebuildTrigger(interval=float(options.get('--watch-interval', 60)),
+            touch_file=options.get('--watch-touch', os.path.join(DATA_DIR, "rebuild")),
+            port=int(port) if port is not None else None)
+        trigger.start()
+        commits = {repo: repo_head(os.path.join(path, repo)) for repo in repos}
+        self.publish(copy.deepcopy(channel_tree))
+        try:
+            while True:
+                reason = trigger.wait()
+                #a failed pull or rebuild keeps the previous tree and commits,
+                #the changes are built again on the next trigger
+                try:
+                    changes, heads = OrderedDict(), {}
+                    for repo in repos:
+                        repo_dir = os.path.join(path, repo)
+                        clone_repo(REPOSITORY_URL[repo], repo_dir)
+                        heads[repo] = repo_head(repo_dir)
+                        if heads[repo] != commits[repo]:
+                            changes[repo] = changed_files(repo_dir, commits[repo], heads[repo])
+                    if len(changes) == 0:
+                        LOGGER.info("No changes ({})".format(reason))
+                        continue
+                    start = time.time()
+                    LOGGER.info("{} failed resources to retry".format(RESOURCES.expire_failures()))
+                    tree = copy.deepcopy(channel_tree)
+                    new_units = self.rebuild(tree, repos, units, changes)
+                    resolve_videos(tree)
+                    self.publish(copy.deepcopy(tree))
+                except Exception as e:
+                    LOGGER.exception("Rebuild failed ({}), keeping the previous tree: {}".format(
+                        reason, e))
+                    continue
+                channel_tree.clear()
+                channel_tree.update(tree)
+                units = new_units
+                commits.update(heads)
+                LOGGER.info("Tree rebuilt in {:.1f}s ({})".format(time.time() - start, reason))
+        finally:
+            trigger.stop()
+
+    def rebuild(self, channel_tree, repos, units, changes):
+        path = os.path.join(DATA_DIR, "git")
+        new_units = repository_units(repos, path)
+        for repo, files in changes.items():
+            repo_dir = os.path.join(path, repo)
+            old_dirs = group_units([unit for unit in units if unit[0] == repo]).get(repo, [])
+            repo_units = [unit for unit in new_units if unit[0] == repo]
+            dirs = group_units(repo_units).get(repo, [])
+            if "README.md" in files or old_dirs != dirs:
+                LOGGER.info("Rebuilding {}".format(repo))
+                remove_child(channel_tree, urljoin(BASE_URL, repo + "/"))
+                self.check_urls(repo_units)
+                #the pre-pass numbers the titles too, the counters are reset after it
+                reset_counters(repo_dir)
+                self._build_scraping_json_tree(channel_tree, repo_dir, dirs)
+                order = {urljoin(BASE_URL, repo + "/"): i for i, repo in enumerate(REPOSITORY_URL)}
+                channel_tree["children"].sort(key=lambda node: order.get(node["source_id"], -1))
+                continue
+
+            repo_topic = get_node_from_channel(urljoin(BASE_URL, repo + "/"), channel_tree)
+            changed_dirs = set(filepath.split("/")[0] for filepath in files if "/" in filepath)
+            for unit in repo_units:
+                directory = unit[1]
+                if directory not in changed_dirs:
+                    continue
+                LOGGER.info("Rebuilding {}/{}".format(repo, directory))
+                remove_child(repo_topic, urljoin(BASE_URL, "{}/{}/".format(repo, directory)))
+                self.check_urls([unit])
+                reset_counters(os.path.join(repo_dir, directory))
+                folder_walker(repo_dir, [directory], channel_tree)
+            order = {urljoin(BASE_URL, "{}/{}/".format(repo, directory)): i
+                for i, directory in enumerate(dirs)}
+            repo_topic["children"].sort(key=lambda node: order.get(node["source_id"], -1))
+        return new_units
+
     def write_tree_to_json(self, channel_tree, lang):
-        write_tree_to_json_tree(self.scrape_stage, channel_tree)
+        profile_memory("write_tree")
+        #the tree and the checksums of the previous run are kept for the diff
+        if if_file_exists(self.scrape_stage):
+            os.replace(self.scrape_stage, self.stage_path("prev.json"))
+            if if_file_exists(self.manifest_path):
+                shutil.copyfile(self.manifest_path, self.stage_path("manifest.prev.json"))
+        jsontrees.write_tree_to_json_tree(self.scrape_stage, channel_tree)
+        manifest = self.write_manifest(channel_tree)
+        self.write_diff(manifest)
+
+    #md5/sha256/size of every file in the tree, the upload stage can trust an
+    #entry while the size and mtime of its file are the same
+    def write_manifest(self, channel_tree):
+        manifest = MANIFEST if MANIFEST is not None else Manifest(self.manifest_path)
+        manifest.record_tree(channel_tree)
+        manifest.save()
+        manifest.report()
+        return manifest
+
+    #compares the tree just written with the one of the previous run, both read
+    #from disk, and writes the diff and a tree with only the changed nodes
+    def write_diff(self, manifest):
+        prev_path = self.stage_path("prev.json")
+        if not if_file_exists(prev_path):
+            LOGGER.info("No previous tree to compare with")
+            return
+        with open(prev_path, "r") as f:
+            prev_tree = json.load(f)
+        prev_digests = {}
+        if if_file_exists(self.stage_path("manifest.prev.json")):
+            with open(self.stage_path("manifest.prev.json"), "r") as f:
+                prev_digests = json.load(f).get("files", {})
+        with open(self.scrape_stage, "r") as f:
+            tree = json.load(f)
+
+        old, new = TreeIndex(prev_tree, prev_digests), TreeIndex(tree, manifest.entries)
+        diff = diff_trees(old, new)
+        with open(self.stage_path("diff.json"), "w") as f:
+            json.dump(diff, f, indent=2)
+        LOGGER.info("Tree diff: {added} added, {removed} removed, {moved} moved, "
+            "{changed} changed nodes, {files} changed files".format(**diff["summary"]))
+        jsontrees.write_tree_to_json_tree(self.stage_path("partial.json"),
+            partial_tree(old, new))
+
+    def write_shard(self, channel_tree, shard, units):
+        profile_memory("write_tree", shard=shard)
+        build_path([LaboratoriaChef.SHARDS_DATA_DIR])
+        filepath = os.path.join(LaboratoriaChef.SHARDS_DATA_DIR, shard_filename(shard))
+        order = units[0][2] if len(units) > 0 else (len(REPOSITORY_URL), 0)
+        with open(filepath, "w") as f:
+            json.dump(dict(shard=shard, order=order, units=[unit[:2] for unit in units],
+                tree=channel_tree), f, indent=2)
+        #the checksums computed while writing are merged with the tree
+        MANIFEST.record_tree(channel_tree)
+        MANIFEST.save(shard_manifest_filename(filepath))
+        LOGGER.info("Shard {} written to {}".format(shard, filepath))
+
+    def merge(self, filepaths):
+        if len(filepaths) == 0:
+            filepaths = sorted(filepath for filepath in
+                glob.glob(os.path.join(LaboratoriaChef.SHARDS_DATA_DIR, "*.json"))
+                if not filepath.endswith(".manifest.json"))
+            if len(filepaths) == 0:
+                raise ValueError("No shard files in {}, build them with --shard".format(
+                    LaboratoriaChef.SHARDS_DATA_DIR))
+        LOGGER.info("Merging shards {}".format(", ".join(filepaths)))
+        channel_tree = merge_shards(filepaths)
+        #the shards may have been built on other hosts, their chefdata must be
+        #collected here before merging
+        missing = missing_files(channel_tree)
+        if len(missing) > 0:
+            raise ValueError("{} files of the merged tree are missing, collect the chefdata "
+                "of every shard first: {}".format(len(missing), ", ".join(missing[:10])))
+
+        global MANIFEST
+        MANIFEST = Manifest(self.manifest_path)
+        for filepath in filepaths:
+            if if_file_exists(shard_manifest_filename(filepath)):
+                with open(shard_manifest_filename(filepath), "r") as f:
+                    MANIFEST.adopt(json.load(f).get("files", {}))
+        self.write_tree_to_json(channel_tree, "en")
 
-    def _build_scraping_json_tree(self, channel_tree, repo_dir):
+    def _build_scraping_json_tree(self, channel_tree, repo_dir, dirs):
         readme = MarkdownReader(os.path.join(repo_dir, "README.md"), extra_files_path="files/")
         readme.load_content()
         readme.write(channel_tree)
         COPYRIGHT_HOLDER = readme.copyright
-        dirs = readme.read_dir()
-        if "00-template" in dirs:
-            dirs = dirs[1:] #skiped 00-template dir
-        folder_walker(repo_dir, dirs, channel_tree)
-        clean_leafs_nodes_plus(channel_tree)
+        for directory in dirs:
+            folder_walker(repo_dir, [directory], channel_tree)
+            profile_memory("directory", repo=os.path.basename(repo_dir), directory=directory)
 
     def download_css_js(self):
-        r = requests.get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/css/styles.css")
+        r = http_client().get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/css/styles.css")
         with open("chefdata/styles.css", "wb") as f:
             f.write(r.content)
 
-        r = requests.get("https://raw.githubusercontent.com/richleland/pygments-css/master/default.css")
+        r = http_client().get("https://raw.githubusercontent.com/richleland/pygments-css/master/default.css")
         with open("chefdata/highlight_default.css", "w") as f:
             f.write(r.content.decode("utf-8").replace(".highlight", ".codehilite"))
 
-        r = requests.get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/js/scripts.js")
+        r = http_client().get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/js/scripts.js")
         with open("chefdata/scripts.js", "wb") as f:
             f.write(r.content)
         
+def make_chef():
+    chef_class = type("LaboratoriaChef", (LaboratoriaChef, ricecooker_chefs.JsonTreeChef), {})
+    return chef_class()
+
+
 def test():
     channel_tree = dict(
         source_domain="",
@@ -916,6 +1454,9 @@ def test():
 # CLI: This code will run when `souschef.py` is called on the command line
 ################################################################################
 if __name__ == '__main__':
-    chef = LaboratoriaChef()
-    chef.main()
+    chef = make_chef()
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        chef.merge(sys.argv[2:])
+    else:
+        chef.main()
     #test()
@@ -0,0 +1,34 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFERRED = ("bs4", "markdown2", "git", "aiohttp", "PIL", "youtube_dl")
+SCRIPT = "import json, sys, sushichef; print(json.dumps(sorted(sys.modules)))"
+
+
+def import_sushichef():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", SCRIPT], cwd=ROOT,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = set(json.loads(result.stdout.splitlines()[-1]))
+    #import time: self [us] | cumulative | imported package
+    total = 0
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[-1].strip() == "sushichef":
+            total = int(fields[1])
+    return modules, total
+
+
+@pytest.mark.skipif(any(importlib.util.find_spec(name) is None
+        for name in ("ricecooker", "le_utils")), reason="ricecooker is not installed")
+def test_heavy_modules_are_deferred():
+    modules, total = import_sushichef()
+    print("import sushichef: {:.1f} ms".format(total / 1000.))
+    loaded = [name for name in DEFERRED if name in modules]
+    assert loaded == [], "imported on startup: {}".format(", ".join(loaded))
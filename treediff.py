@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+
+
+LOGGER = logging.getLogger()
+
+#fields of a node that aren't compared as metadata
+STRUCTURE_FIELDS = ("children", "files")
+
+
+def file_id(file_):
+    return file_.get("path") or file_.get("url") or ""
+
+
+#Flat index of a tree in two passes: source_id -> node, parent and subtree
+#hash. The same resource reused in several places of the tree (registry reuse)
+#has the same source_id, those nodes are told apart by their parent
+class TreeIndex(object):
+    def __init__(self, tree, digests=None):
+        self.digests = digests if digests is not None else {}
+        self.nodes = {}
+        self.parents = {}
+        self.hashes = {}
+        counts = {}
+        nodes = [tree]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            counts[node.get("source_id")] = counts.get(node.get("source_id"), 0) + 1
+            nodes.extend(node.get("children", []))
+        self.duplicates = set(source_id for source_id, count in counts.items() if count > 1)
+
+        self.keys = {}
+        order = []
+        nodes = [(tree, None)]
+        while len(nodes) > 0:
+            node, parent_key = nodes.pop()
+            key = self.add(node, parent_key)
+            order.append(key)
+            nodes.extend((child, key) for child in node.get("children", []))
+        self.root = order[0]
+        for key in reversed(order):
+            self.hashes[key] = self.subtree_hash(key)
+
+    def node_key(self, node, parent_key):
+        source_id = node.get("source_id")
+        if source_id in self.duplicates:
+            return "{} > {}".format(parent_key, source_id)
+        return source_id
+
+    def add(self, node, parent_key):
+        key = self.node_key(node, parent_key)
+        self.nodes[key] = node
+        self.parents[key] = parent_key
+        self.keys[id(node)] = key
+        return key
+
+    def files(self, key):
+        files = {}
+        for file_ in self.nodes[key].get("files", []):
+            entry = self.digests.get(file_.get("path"), {})
+            files[file_id(file_)] = dict(file_type=file_.get("file_type"),
+                sha256=entry.get("sha256"), size=entry.get("size"))
+        return files
+
+    #every file of the tree by path, a file reused by several nodes is listed
+    #once with the source_id of the first one
+    def all_files(self):
+        files, source_ids = {}, {}
+        for key in self.nodes:
+            for path, entry in self.files(key).items():
+                files[path] = entry
+                source_ids.setdefault(path, self.nodes[key].get("source_id"))
+        return files, source_ids
+
+    #by source_id, the key of a reused node changes when it stops being reused
+    def child_ids(self, key):
+        return [child.get("source_id") for child in self.nodes[key].get("children", [])]
+
+    def metadata(self, key):
+        return {field: value for field, value in self.nodes[key].items()
+            if field not in STRUCTURE_FIELDS}
+
+    #children are hashed before their parents, see __init__
+    def subtree_hash(self, key):
+        node = self.nodes[key]
+        sha = hashlib.sha256(json.dumps([self.metadata(key), self.files(key)],
+            sort_keys=True, default=str).encode("utf-8"))
+        for child in node.get("children", []):
+            child_key = self.keys[id(child)]
+            sha.update("{}:{}".format(child_key, self.hashes[child_key]).encode("utf-8"))
+        return sha.hexdigest()
+
+
+def node_summary(index, key):
+    node = index.nodes[key]
+    return dict(source_id=node.get("source_id"), title=node.get("title"),
+        kind=node.get("kind"), parent=index.parents[key])
+
+
+def diff_files(old_files, new_files):
+    changes = []
+    for path in sorted(set(old_files) | set(new_files)):
+        old, new = old_files.get(path), new_files.get(path)
+        if old == new:
+            continue
+        status = "added" if old is None else "removed" if new is None else "changed"
+        current = new if new is not None else old
+        changes.append(dict(path=path, status=status, file_type=current["file_type"],
+            sha256=new["sha256"] if new is not None else None,
+            previous_sha256=old["sha256"] if old is not None else None))
+    return changes
+
+
+#Structural diff of two trees: added, removed, moved (different parent) and
+#changed (metadata or files) nodes, in time linear in the size of the trees
+def diff_trees(old, new):
+    added_keys = [key for key in new.nodes if key not in old.nodes]
+    removed_keys = [key for key in old.nodes if key not in new.nodes]
+    added = [node_summary(new, key) for key in added_keys]
+    removed = [node_summary(old, key) for key in removed_keys]
+    moved, changed = [], []
+    #the files are compared by path, a file reused by several nodes is only
+    #removed when no node has it anymore
+    old_files, old_sources = old.all_files()
+    new_files, new_sources = new.all_files()
+    files = [dict(change, source_id=new_sources.get(change["path"], old_sources.get(change["path"])))
+        for change in diff_files(old_files, new_files)]
+    unchanged = 0
+    for key in new.nodes:
+        if key not in old.nodes:
+            continue
+        if old.hashes[key] == new.hashes[key]:
+            unchanged += 1
+        if old.parents[key] != new.parents[key]:
+            moved.append(dict(node_summary(new, key), previous_parent=old.parents[key]))
+        old_metadata, new_metadata = old.metadata(key), new.metadata(key)
+        fields = sorted(field for field in set(old_metadata) | set(new_metadata)
+            if old_metadata.get(field) != new_metadata.get(field))
+        file_changes = diff_files(old.files(key), new.files(key))
+        if len(fields) > 0 or len(file_changes) > 0:
+            changed.append(dict(node_summary(new, key), fields=fields,
+                files=[change["path"] for change in file_changes]))
+    summary = dict(added=len(added), removed=len(removed), moved=len(moved),
+        changed=len(changed), files=len(files), unchanged_subtrees=unchanged)
+    return dict(summary=summary, added=added, removed=removed, moved=moved,
+        changed=changed, files=files)
+
+
+def removed_children(old, new, key):
+    if key not in old.nodes:
+        return []
+    source_ids = set(new.child_ids(key))
+    return [source_id for source_id in old.child_ids(key) if source_id not in source_ids]
+
+
+def node_changed(old, new, key):
+    return key not in old.nodes or old.parents[key] != new.parents[key] or\
+        old.metadata(key) != new.metadata(key) or old.files(key) != new.files(key) or\
+        old.child_ids(key) != new.child_ids(key)
+
+
+#copy of the new tree with only what changed since the previous tree: new,
+#moved and changed nodes and their ancestors. A topic that lost children (removed
+#or moved away) is changed and lists their source_ids in removed_children. A
+#topic is never left empty, a changed topic without changed children keeps all
+#of them
+def partial_tree(old, new, node=None):
+    node = new.nodes[new.root] if node is None else node
+    children = []
+    for child in node.get("children", []):
+        key = new.keys[id(child)]
+        if old.hashes.get(key) == new.hashes[key] and old.parents.get(key) == new.parents[key]:
+            continue
+        if node_changed(old, new, key) and "children" in child:
+            partial = partial_tree(old, new, child)
+            if len(partial["children"]) == 0:
+                partial["children"] = child["children"]
+            children.append(partial)
+        elif node_changed(old, new, key):
+            children.append(child)
+        else:
+            partial = partial_tree(old, new, child)
+            if len(partial.get("children", [])) > 0:
+                children.append(partial)
+    partial = {field: value for field, value in node.items() if field != "children"}
+    if "children" in node:
+        partial["children"] = children
+    removed = removed_children(old, new, new.keys[id(node)])
+    if len(removed) > 0:
+        partial["removed_children"] = removed
+    return partial
@@ -0,0 +1,62 @@
+from collections import namedtuple
+from functools import lru_cache
+import re
+from urllib.parse import urljoin
+
+
+URL_CACHE_SIZE = 4096
+
+IMAGE = "image"
+PDF = "pdf"
+DRIVE = "drive"
+YOUTUBE = "youtube"
+WISTIA = "wistia"
+OTHER = "other"
+
+UrlInfo = namedtuple("UrlInfo", ["kind", "key", "url"])
+
+#one alternation for every kind of resource we know how to fetch, the first
+#match from the left wins, so hosts are recognized before file extensions
+URL_PATTERN = re.compile(r"""
+    (?:youtube(?:-nocookie)?\.com/+(?:watch/?\?(?:[^#]*?&)?v=|embed/|v/)|youtu\.be/)
+        (?P<youtube>[\w-]{11})
+  | (?:drive|docs)\.google\.com/+(?:file/d/|(?:open|uc)\?(?:[^#]*?&)?id=)
+        (?P<drive>[\w-]+)
+  | wistia\.(?:com|net)/+(?:medias|embed/iframe|embed/medias)/
+        (?P<wistia>\w+)
+  | \.(?:(?P<pdf>pdf)|(?P<image>png|jpe?g|gif|svg|webp|bmp))(?=$|[?#&])
+""", re.VERBOSE | re.IGNORECASE)
+PARAMS_PATTERN = re.compile(r"[?&]")
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def classify_url(url):
+    url = url.strip()
+    match = URL_PATTERN.search(url)
+    if match is not None:
+        kind = match.lastgroup
+        if kind in (YOUTUBE, DRIVE, WISTIA):
+            return UrlInfo(kind, "{}:{}".format(kind, match.group(kind)), url)
+        return UrlInfo(kind, normalize_url(url), url)
+    return UrlInfo(OTHER, normalize_url(url), url)
+
+
+def normalize_url(url):
+    url = url.strip().split("#", 1)[0]
+    if url.endswith("/"):
+        url = url[:-1]
+    return url
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def resolve_url(url, base_url):
+    url = url.strip()
+    if url.startswith("http://") or url.startswith("https://"):
+        return url
+    return urljoin(base_url, url)
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def get_name_from_url(url):
+    name = url[max(url.rfind("/"), url.rfind("\\")) + 1:]
+    return PARAMS_PATTERN.split(name, 1)[0] or name.split("&", 1)[0]
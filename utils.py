@@ -1,9 +1,25 @@
-from git import Repo
-import ntpath
+import importlib
+from manifest import HashingWriter
 import os
 from pathlib import Path
 
 
+#Module proxy imported on the first attribute access, keeps the heavy
+#dependencies out of the startup path of the chef and its worker processes
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+git = LazyModule("git")
+
+
 def if_dir_exists(filepath):
     file_ = Path(filepath)
     return file_.is_dir()
@@ -20,43 +36,26 @@ def remove_links(content):
             link.replaceWithChildren()
 
 
-def get_name_from_url(url):
-    head, tail = ntpath.split(url)
-    params_index = tail.find("&")
-    if params_index != -1:
-        tail = tail[:params_index]
-    params_index = tail.find("?")
-    if params_index != -1:
-        tail = tail[:params_index]
-
-    basename = ntpath.basename(url)
-    params_b_index = basename.find("&")
-    if params_b_index != -1:
-        basename = basename[:params_b_index]
-    return tail or basename
-
-
-def get_name_from_url_no_ext(url):
-    path = get_name_from_url(url)
-    path_split = path.split(".")
-    if len(path_split) > 1:
-        name = ".".join(path_split[:-1])
-    else:
-        name = path_split[0]
-    return name
-
-
 def clone_repo(git_url, repo_dir):
     if not if_dir_exists(repo_dir):
         print("Cloning repository {}".format(git_url))
-        Repo.clone_from(git_url, repo_dir)
+        git.Repo.clone_from(git_url, repo_dir)
     else:
         print("Pulling data from repository {}".format(git_url))
-        repo = Repo(repo_dir)
+        repo = git.Repo(repo_dir)
         for info in repo.remotes.origin.pull():
             print(info)
 
 
+def repo_head(repo_dir):
+    return git.Repo(repo_dir).head.commit.hexsha
+
+
+def changed_files(repo_dir, old_commit, new_commit):
+    diff = git.Repo(repo_dir).git.diff("--name-only", old_commit, new_commit)
+    return [line for line in diff.splitlines() if line]
+
+
 def build_path(levels):
     path = os.path.join(*levels)
     if not if_dir_exists(path):
@@ -64,19 +63,6 @@ def build_path(levels):
     return path
 
 
-def get_video_resolution_format(video, maxvres=720, ext="mp4"):
-    formats = [(int(s.resolution.split("x")[1]), s.extension, s) for s in video.videostreams]
-    formats = sorted(formats, key=lambda x: x[0])
-    best = None
-    for r, x, stream in formats:
-        if r <= maxvres and x == ext:
-            best = stream
-    if best is None:
-        return video.getbest(preftype=ext)
-    else:
-        return best
-
-
 def get_node_from_channel(source_id, channel_tree, exclude=None):
     parent = channel_tree["children"]
     while len(parent) > 0:
@@ -120,7 +106,9 @@ def get_confirm_token(response):
 def save_response_content(response, destination):
     CHUNK_SIZE = 32768
     with open(destination, "wb") as f:
+        writer = HashingWriter(f)
         for chunk in response.iter_content(CHUNK_SIZE):
             if chunk:
-                f.write(chunk)
+                writer.write(chunk)
                 f.flush()
+    return writer.digests()
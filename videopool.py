@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from urllib.error import URLError
+
+from utils import LazyModule
+
+
+youtube_dl = LazyModule("youtube_dl")
+
+LOGGER = logging.getLogger()
+
+MAX_HEIGHT = 480
+VIDEO_EXT = "mp4"
+AUDIO_EXT = "m4a"
+#the same rule youtube_dl applies when the format can't be chosen beforehand
+DEFAULT_FORMAT = "bestvideo[height<={maxheight}][ext={video}]+bestaudio[ext={audio}]/"\
+    "best[height<={maxheight}][ext={video}]".format(
+        maxheight=MAX_HEIGHT, video=VIDEO_EXT, audio=AUDIO_EXT)
+YDL_OPTIONS = {
+    'writesubtitles': False,
+    'no_warnings': True,
+    'restrictfilenames': True,
+    'continuedl': True,
+    'quiet': False,
+    'noplaylist': False
+}
+INFO_FIELDS = ("id", "title", "width", "height")
+FORMAT_FIELDS = ("format_id", "ext", "height", "vcodec", "acodec", "tbr", "abr")
+
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def backoff_delay(attempt, base=0.8, cap=30):
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def select_format(info, maxheight=MAX_HEIGHT):
+    formats = info.get("formats") or []
+    fits = lambda f: (f.get("height") or 0) <= maxheight
+    videos = [f for f in formats if f.get("acodec") == "none" and f.get("vcodec") != "none"\
+        and f.get("ext") == VIDEO_EXT and fits(f)]
+    audios = [f for f in formats if f.get("vcodec") == "none" and f.get("ext") == AUDIO_EXT]
+    if len(videos) > 0 and len(audios) > 0:
+        video = max(videos, key=lambda f: (f.get("height") or 0, f.get("tbr") or 0))
+        audio = max(audios, key=lambda f: f.get("abr") or f.get("tbr") or 0)
+        return "{}+{}".format(video["format_id"], audio["format_id"])
+
+    progressive = [f for f in formats if f.get("acodec") != "none" and f.get("vcodec") != "none"\
+        and f.get("ext") == VIDEO_EXT and fits(f)]
+    if len(progressive) > 0:
+        return max(progressive, key=lambda f: (f.get("height") or 0, f.get("tbr") or 0))["format_id"]
+    return DEFAULT_FORMAT
+
+
+#Downloads youtube videos in a thread pool, every worker keeps its own
+#YoutubeDL instance and every extraction waits for the shared rate limiter.
+#Futures are kept by resource key, so a video submitted twice is fetched once
+class VideoWorkerPool(object):
+    def __init__(self, workers=4, rate=1., retries=4, metadata_dir=None, postprocess=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.postprocess = postprocess
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.metadata_dir = metadata_dir
+        self.metadata = {}
+        self.from_disk = set()
+        self.futures = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if metadata_dir is not None and not os.path.isdir(metadata_dir):
+            os.makedirs(metadata_dir)
+
+    def extractor(self):
+        if getattr(self.local, "ydl", None) is None:
+            self.local.ydl = youtube_dl.YoutubeDL(dict(YDL_OPTIONS))
+        return self.local.ydl
+
+    def metadata_path(self, url):
+        if self.metadata_dir is not None:
+            name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+            return os.path.join(self.metadata_dir, "{}.json".format(name))
+
+    #only the fields used to choose the format and build the node are kept
+    def trim_info(self, info):
+        trimmed = {field: info.get(field) for field in INFO_FIELDS}
+        trimmed["formats"] = [{field: f.get(field) for field in FORMAT_FIELDS}
+            for f in info.get("formats") or []]
+        trimmed["subtitles"] = sorted((info.get("subtitles") or {}).keys())
+        return trimmed
+
+    def info(self, url):
+        with self.lock:
+            if url in self.metadata:
+                return self.metadata[url]
+        path = self.metadata_path(url)
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                info = json.load(f)
+            with self.lock:
+                self.from_disk.add(url)
+        else:
+            self.limiter.wait()
+            info = self.trim_info(self.extractor().extract_info(url, download=False))
+            if path is not None:
+                with open(path, "w") as f:
+                    json.dump(info, f)
+        with self.lock:
+            self.metadata[url] = info
+        return info
+
+    #drops the metadata of url, the next info() extracts it again
+    def forget(self, url):
+        with self.lock:
+            self.metadata.pop(url, None)
+            self.from_disk.discard(url)
+        path = self.metadata_path(url)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def submit(self, key, url, download_to):
+        with self.lock:
+            if key not in self.futures:
+                self.futures[key] = self.executor.submit(self.download, url, download_to)
+            return self.futures[key]
+
+    def download(self, url, download_to):
+        for attempt in range(self.retries):
+            try:
+                info = self.info(url)
+                ydl = self.extractor()
+                ydl.params.update(format=select_format(info),
+                    outtmpl=os.path.join(download_to, "%(id)s.%(ext)s"))
+                self.limiter.wait()
+                ydl.extract_info(url, download=True)
+                filepath = os.path.join(download_to, "{}.{}".format(info["id"], VIDEO_EXT))
+                if self.postprocess is not None:
+                    filepath = self.postprocess(filepath)
+                return dict(info, filepath=filepath)
+            except (youtube_dl.utils.DownloadError, youtube_dl.utils.ContentTooShortError,
+                    youtube_dl.utils.ExtractorError) as e:
+                #the formats chosen from metadata of a previous run may not exist anymore
+                with self.lock:
+                    stale = url in self.from_disk
+                if stale:
+                    LOGGER.info("Download failed with cached metadata, extracting it again. {}".format(e))
+                    self.forget(url)
+                    continue
+                LOGGER.info("An error ocurred, may be the video is not available. {}".format(e))
+                return
+            except (ValueError, IOError, OSError, URLError, ConnectionResetError) as e:
+                LOGGER.info(e)
+                delay = backoff_delay(attempt)
+                LOGGER.info("Download retry in {:.1f}s".format(delay))
+                time.sleep(delay)
+            except KeyError as e:
+                LOGGER.info(str(e))
+                return
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,347 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from manifest import HashingWriter
+from utils import LazyModule
+
+
+aiohttp = LazyModule("aiohttp")
+multidict = LazyModule("multidict")
+
+LOGGER = logging.getLogger()
+
+CHUNK_SIZE = 32768
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+#cache policies by host, FOREVER never asks again, REVALIDATE always sends
+#a conditional request with the stored ETag/Last-Modified and DEFAULT follows
+#the Cache-Control headers of the response
+FOREVER = "forever"
+REVALIDATE = "revalidate"
+DEFAULT = "default"
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Response(object):
+    def __init__(self, url, status, headers, content=None, cookies=None, from_cache=False):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.cookies = cookies or {}
+        self.from_cache = from_cache
+        self.path = None
+        self.digests = None
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        for index in range(0, len(self.content), chunk_size):
+            yield self.content[index:index+chunk_size]
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HTTPError("{} for url {}".format(self.status, self.url))
+
+
+#All the responses live in one sqlite file, the least recently used entries
+#are evicted when the bodies go over max_size bytes. The access times of the
+#hits are written in batches, before an eviction or every flush_every hits
+class SQLiteCache(object):
+    def __init__(self, path, max_size=1024 * 1024 * 1024, flush_every=256):
+        self.path = path
+        self.max_size = max_size
+        self.flush_every = flush_every
+        self.evictions = 0
+        self.accessed = {}
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+            "meta TEXT, content BLOB, size INTEGER, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT meta, content FROM entries WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= self.flush_every:
+                self.flush_accessed()
+        entry = json.loads(row[0])
+        entry["content"] = row[1]
+        return entry
+
+    def set(self, key, entry):
+        size = len(entry["content"])
+        if size > self.max_size // 8:
+            return
+        meta = json.dumps({k: v for k, v in entry.items() if k != "content"})
+        with self.lock:
+            self.accessed.pop(key, None)
+            row = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, meta, sqlite3.Binary(entry["content"]), size, time.time()))
+            self.size += size
+            if self.size > self.max_size:
+                self.flush_accessed()
+                self.evict()
+            self.db.commit()
+
+    #a revalidated entry only gets new metadata, the content is kept
+    def update_meta(self, key, entry):
+        meta = json.dumps({k: v for k, v in entry.items() if k != "content"})
+        with self.lock:
+            self.accessed.pop(key, None)
+            self.db.execute("UPDATE entries SET meta = ?, accessed = ? WHERE key = ?",
+                (meta, time.time(), key))
+            self.db.commit()
+
+    def flush_accessed(self):
+        with self.lock:
+            if len(self.accessed) > 0:
+                self.db.executemany("UPDATE entries SET accessed = ? WHERE key = ?",
+                    [(accessed, key) for key, accessed in self.accessed.items()])
+                self.db.commit()
+                self.accessed = {}
+
+    def evict(self):
+        while self.size > self.max_size:
+            row = self.db.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT 1").fetchone()
+            #the table is empty, another process shares the file and evicted it
+            if row is None:
+                self.size = 0
+                break
+            key, size = row
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size -= size
+            self.evictions += 1
+
+    def close(self):
+        with self.lock:
+            self.flush_accessed()
+            self.db.close()
+
+
+#All the chef requests go through one asyncio loop running in a background
+#thread, the sync methods can be called from any thread and block until the
+#coroutine is done, get_many keeps every request of the batch in flight.
+#The sqlite cache is read and written in its own thread, off the loop
+class AsyncHTTPClient(object):
+    def __init__(self, cache=None, policies=None, limit=100, limit_per_host=8,
+            timeout=60, retries=3, backoff=0.5):
+        self.cache = cache
+        self.policies = policies or {}
+        self.stats = dict(hits=0, misses=0, revalidated=0, stored=0)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = None
+        self.session = None
+        self.cache_executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name="http-loop")
+                thread.daemon = True
+                thread.start()
+        return self.loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.start()).result()
+
+    def get(self, url, params=None):
+        return self.run(self.request(url, params=params))
+
+    def get_many(self, urls):
+        async def gather():
+            return await asyncio.gather(*[self.request(url) for url in urls],
+                return_exceptions=True)
+        return self.run(gather())
+
+    def download(self, url, destination, content_type=None):
+        return self.run(self.request(url, stream_to=destination, content_type=content_type))
+
+    def close(self):
+        if self.loop is not None:
+            if self.session is not None:
+                self.run(self.session.close())
+                self.session = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+        self.cache_executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def report(self):
+        LOGGER.info("HTTP cache: {hits} hits, {revalidated} revalidated, {misses} misses, "
+            "{stored} stored".format(**self.stats))
+        if self.cache is not None:
+            LOGGER.info("HTTP cache: {} entries, {:.1f} MB, {} evicted".format(
+                len(self.cache), self.cache.size / (1024 * 1024.), self.cache.evictions))
+
+    async def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                limit_per_host=self.limit_per_host, keepalive_timeout=30)
+            self.session = aiohttp.ClientSession(connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def cache_key(self, url, params=None):
+        if params:
+            url = "{}?{}".format(url, urlencode(sorted(params.items())))
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def policy(self, url):
+        host = urlsplit(url).hostname or ""
+        while host:
+            if host in self.policies:
+                return self.policies[host]
+            host = host.partition(".")[2]
+        return DEFAULT
+
+    #None means the response can't be stored, 0 that it never expires
+    def expires(self, url, response):
+        if response.status != 200:
+            return None
+        policy = self.policy(url)
+        if policy == FOREVER:
+            return 0
+        validators = "etag" in response.headers or "last-modified" in response.headers
+        if policy == REVALIDATE:
+            return time.time() if validators else None
+        cache_control = response.headers.get("cache-control", "")
+        if "no-store" in cache_control:
+            return None
+        match = MAX_AGE_PATTERN.search(cache_control)
+        if match is not None and int(match.group(1)) > 0 and not "no-cache" in cache_control:
+            return time.time() + int(match.group(1))
+        elif validators:
+            return time.time()
+
+    def cached_response(self, entry):
+        return Response(entry["url"], entry["status"], multidict.CIMultiDict(entry["headers"]),
+            content=entry["content"], from_cache=True)
+
+    def conditional_headers(self, entry):
+        headers = multidict.CIMultiDict(entry["headers"])
+        conditional = {}
+        if "etag" in headers:
+            conditional["If-None-Match"] = headers["etag"]
+        if "last-modified" in headers:
+            conditional["If-Modified-Since"] = headers["last-modified"]
+        return conditional
+
+    async def cache_get(self, key):
+        return await asyncio.get_event_loop().run_in_executor(self.cache_executor,
+            self.cache.get, key)
+
+    async def store(self, key, url, response):
+        expires = self.expires(url, response)
+        if self.cache is not None and expires is not None:
+            entry = dict(url=response.url, status=response.status,
+                headers=list(response.headers.items()), expires=expires,
+                content=response.content)
+            await asyncio.get_event_loop().run_in_executor(self.cache_executor,
+                self.cache.set, key, entry)
+            self.stats["stored"] += 1
+
+    async def refresh(self, key, url, entry):
+        expires = self.expires(url, self.cached_response(entry))
+        if self.cache is not None and expires is not None:
+            meta = {k: v for k, v in entry.items() if k != "content"}
+            meta["expires"] = expires
+            await asyncio.get_event_loop().run_in_executor(self.cache_executor,
+                self.cache.update_meta, key, meta)
+
+    #the body goes to a temporary file that replaces destination only when
+    #it is complete, a failed download leaves nothing behind
+    async def stream(self, resp, destination):
+        tmp_destination = destination + ".tmp"
+        try:
+            with open(tmp_destination, "wb") as f:
+                writer = HashingWriter(f)
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    writer.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp_destination):
+                os.remove(tmp_destination)
+            raise
+        os.replace(tmp_destination, destination)
+        return writer.digests()
+
+    async def request(self, url, params=None, stream_to=None, content_type=None):
+        key = self.cache_key(url, params)
+        entry = None
+        headers = {}
+        if stream_to is None and self.cache is not None:
+            entry = await self.cache_get(key)
+            if entry is not None:
+                if entry["expires"] == 0 or entry["expires"] > time.time():
+                    self.stats["hits"] += 1
+                    return self.cached_response(entry)
+                headers = self.conditional_headers(entry)
+
+        session = await self.get_session()
+        #a download can take longer than the total timeout, only the
+        #connection and each read are limited
+        options = {}
+        if stream_to is not None:
+            options["timeout"] = aiohttp.ClientTimeout(total=None, connect=self.timeout,
+                sock_read=self.timeout)
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url, params=params, headers=headers, **options) as resp:
+                    if resp.status == 304 and entry is not None:
+                        self.stats["revalidated"] += 1
+                        await self.refresh(key, url, entry)
+                        return self.cached_response(entry)
+                    elif resp.status in RETRY_STATUSES and attempt < self.retries:
+                        error = HTTPError("{} for url {}".format(resp.status, url))
+                    else:
+                        response = Response(str(resp.url), resp.status, multidict.CIMultiDict(resp.headers),
+                            cookies={name: morsel.value for name, morsel in resp.cookies.items()})
+                        if stream_to is None:
+                            response.content = await resp.read()
+                            self.stats["misses"] += 1
+                            await self.store(key, url, response)
+                        elif resp.status == 200 and (content_type is None or\
+                                content_type in response.headers.get("content-type", "")):
+                            response.digests = await self.stream(resp, stream_to)
+                            response.path = stream_to
+                        return response
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt < self.retries:
+                LOGGER.info("Request retry {} {}".format(url, error))
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        raise HTTPError("{} for url {}".format(error, url))